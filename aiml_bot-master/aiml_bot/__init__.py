@@ -1,5 +1,8 @@
+import argparse
 import os
+import shutil
 import sys
+import threading
 import traceback
 
 
@@ -32,8 +35,38 @@ BRAIN_PATH
 --no-std
     Do not automatically load the standard AIML rules.
 
+--rebuild-std
+    Rebuild the precompiled standard brain that ships with the package
+    from the currently installed AIML files, then exit.
+
 """.strip()
 
+# A precompiled brain containing the standard AIML rules. If present, it is
+# copied into place the first time a brain file is needed, so new users
+# don't have to wait for the standard AIML files to be parsed.
+PREBUILT_BRAIN_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'default.brn'))
+
+
+class _ArgumentError(Exception):
+    """Raised by the command-line parser when the arguments are invalid."""
+
+
+class _ArgumentParser(argparse.ArgumentParser):
+    """A command-line parser which raises an _ArgumentError for invalid
+    arguments, instead of printing its own usage message and exiting, so
+    main() can report them along with USAGE."""
+
+    def error(self, message):
+        raise _ArgumentError(message)
+
+
+# The command-line parser is built once, at import time.
+_PARSER = _ArgumentParser(add_help=False, allow_abbrev=False)
+_PARSER.add_argument('brain_path', nargs='?')
+_PARSER.add_argument('-r', '--reset', action='store_true')
+_PARSER.add_argument('-n', '--no-std', action='store_true')
+_PARSER.add_argument('--rebuild-std', action='store_true')
+
 
 def main():
     """
@@ -46,30 +79,44 @@ def main():
     # previous run. If no brain file is available, we force a reload of
     # the AIML files.
 
-    brain_path = None
-    reset = False
-    no_std = False
-    for arg in sys.argv[1:]:
-        if arg in ('-r', '--reset'):
-            reset = True
-        elif arg in ('-n', '--no-std'):
-            no_std = True
-        elif brain_path is None:
-            brain_path = arg
-            if not brain_path.endswith('.brn'):
-                brain_path += '.brn'
-        else:
-            print("Unexpected argument: %s" % arg)
-            print(USAGE)
-            return 1
-
+    try:
+        args, unexpected = _PARSER.parse_known_args(sys.argv[1:])
+    except _ArgumentError as error:
+        print("Invalid argument: %s" % error)
+        print(USAGE)
+        return 1
+    if unexpected:
+        print("Unexpected argument: %s" % unexpected[0])
+        print(USAGE)
+        return 1
+    brain_path = args.brain_path
+    reset = args.reset
+    no_std = args.no_std
+
+    if args.rebuild_std:
+        os.makedirs(os.path.dirname(PREBUILT_BRAIN_PATH), exist_ok=True)
+        Bot(commands="load std aiml").save_brain(PREBUILT_BRAIN_PATH)
+        return 0
+
+    # Normalize the brain path once, up front, and check for it only once.
     if brain_path is None:
-        brain_path = os.path.expanduser('~/.aiml/default.brn')
+        brain_path = '~/.aiml/default.brn'
+    elif not brain_path.endswith('.brn'):
+        brain_path += '.brn'
+    brain_path = os.path.abspath(os.path.expanduser(brain_path))
 
     if not os.path.isfile(brain_path):
-        reset = True
+        # Make sure there's somewhere to save the new brain.
+        os.makedirs(os.path.dirname(brain_path), exist_ok=True)
+        if not (reset or no_std) and os.path.isfile(PREBUILT_BRAIN_PATH):
+            # Start from the precompiled standard brain rather than
+            # parsing the standard AIML files all over again.
+            shutil.copyfile(PREBUILT_BRAIN_PATH, brain_path)
+        else:
+            reset = True
 
     robot = None
+    save_thread = None
 
     if not reset:
         # Attempt to load the brain file.  If it fails, fall back on the
@@ -89,24 +136,41 @@ def main():
         # optional learnFiles argument is a file (or list of files) to load.
         # The optional commands argument is a command (or list of commands)
         # to run after the files are loaded.
+        # Parsed AIML files are cached next to the brain, so resetting again
+        # only parses the files that have changed.
+        cache_dir = os.path.join(os.path.dirname(brain_path), 'cache')
         if no_std:
-            robot = Bot()
+            robot = Bot(cache_dir=cache_dir)
         else:
-            robot = Bot(commands="load std aiml")
+            robot = Bot(commands="load std aiml", cache_dir=cache_dir)
         # Now that we've loaded the brain, save it to speed things up for
-        # next time.
-        robot.save_brain(brain_path)
+        # next time. The save runs in the background so the user can start
+        # typing right away, and quietly, so it doesn't print over the prompt.
+        save_thread = threading.Thread(target=robot.save_brain, args=(brain_path,), kwargs={'verbose': False})
+        save_thread.start()
 
     assert robot is not None, "Bot initialization failed!"
 
     # Enter the main input/output loop.
     print("\nINTERACTIVE MODE (ctrl-c to exit)")
-    while True:
-        try:
-            print(robot.respond(input("> ")))
-        except KeyboardInterrupt:
-            break
-
-    robot.save_brain(brain_path)
+    read_line = sys.stdin.readline
+    write = sys.stdout.write
+    flush = sys.stdout.flush
+    try:
+        while True:
+            write("> ")
+            flush()
+            line = read_line()
+            if not line:
+                break  # End of input
+            write(robot.respond(line.rstrip("\n")) + "\n")
+    except KeyboardInterrupt:
+        pass
+
+    if save_thread is not None:
+        save_thread.join()
+    # Chatting rarely changes the brain, so only save it if it has.
+    if robot.brain_modified:
+        robot.save_brain(brain_path)
 
     return 0
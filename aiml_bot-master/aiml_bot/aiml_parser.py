@@ -30,8 +30,20 @@ class AimlHandler(ContentHandler):
     def __init__(self, encoding="utf-8"):
         super().__init__()
 
-        self.categories = {}
         self._encoding = encoding
+
+        # TODO: select the proper validInfo table based on the version number.
+        self._validInfo = self._validationInfo101
+
+        self._locator = Locator()
+        self.setDocumentLocator(self._locator)
+        self.reset()
+
+    def reset(self):
+        """Forget the current document, so the handler can be reused to
+        parse another one. The categories found so far are left in the
+        old categories dictionary, and a new one is started."""
+        self.categories = {}
         self._state = self._STATE_OutsideAiml
         self._version = ""
         self._namespace = ""
@@ -49,9 +61,6 @@ class AimlHandler(ContentHandler):
         # query with getNumErrors().  If 0, the document is AIML-compliant.
         self._numParseErrors = 0
 
-        # TODO: select the proper validInfo table based on the version number.
-        self._validInfo = self._validationInfo101
-
         # This stack of Booleans is used when parsing <li> elements inside
         # <condition> elements, to keep track of whether or not an
         # attribute-less "default" <li> element has been found yet.  Only
@@ -68,8 +77,6 @@ class AimlHandler(ContentHandler):
         self._whitespaceBehaviorStack = ["default"]
 
         self._elemStack = []
-        self._locator = Locator()
-        self.setDocumentLocator(self._locator)
 
     def getNumErrors(self):
         """Return the number of errors found while parsing the current document."""
@@ -234,11 +241,13 @@ class AimlHandler(ContentHandler):
         elif self._state == self._STATE_InsideTemplate and name in self._validInfo:
             # Starting a new element inside the current pattern. First
             # we need to convert 'attr' into a native Python dictionary,
-            # so it can later be marshaled.
+            # so it can later be marshaled. The names and values are
+            # interned, since they're mostly predicate names shared by many
+            # templates.
             attrDict = {}
             for k, v in attr.items():
                 #attrDict[k[1]] = v
-                attrDict[k] = str(v)
+                attrDict[sys.intern(k)] = sys.intern(str(v))
             self._validateElemStart(name, attrDict, self._version)
             # Push the current element onto the element stack.
             self._elemStack.append([name, attrDict])
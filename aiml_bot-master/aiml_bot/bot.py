@@ -2,21 +2,27 @@
 
 """This file contains the public interface to the aiml module."""
 
-import copy
+import collections
 import glob
+import hashlib
+import itertools
 import os
+import pickle
 import random
-import re
+import stat
 import string
+import subprocess
 import sys
 import threading
 import time
+import types
 import xml.sax
 from configparser import ConfigParser
 
-from .aiml_parser import create_parser
+from .aiml_parser import AimlHandler, create_parser
 from .default_substitutions import default_gender, default_person, default_person2, default_normal
 from .pattern_manager import PatternManager
+from .session import Session
 from .utilities import split_sentences
 from .word_substitutions import WordSub
 
@@ -37,7 +43,7 @@ __version__ = '0.0'
 DEFAULT_ENCODING = 'utf-8'
 DEFAULT_SESSION_ID = "anonymous"
 
-# special predicate keys
+# special predicate keys, used in the session data dictionary
 INPUT_HISTORY = "<INPUT HISTORY>"  # keys to a queue (list) of recent user input
 OUTPUT_HISTORY = "<OUTPUT HISTORY>"  # keys to a queue (list) of recent responses.
 INPUT_STACK = "<INPUT STACK>"  # Should always be empty in between calls to respond()
@@ -45,21 +51,66 @@ INPUT_STACK = "<INPUT STACK>"  # Should always be empty in between calls to resp
 
 BOOTSTRAP_AIML_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'bootstrap.aiml'))
 
+# Elements whose output depends only on the matched input, the bot's previous
+# response, the topic, and the bot predicates. Responses from templates built
+# entirely out of these elements can be safely memoized.
+CACHEABLE_ELEMENTS = frozenset([
+    'bot', 'formal', 'gender', 'lowercase', 'person', 'person2', 'sentence', 'star', 'template', 'text',
+    'thatstar', 'topicstar', 'uppercase', 'version',
+])
+
+# Elements whose output never changes once the bot predicates are set. A
+# template made only of these always produces the same response.
+CONSTANT_ELEMENTS = frozenset(['bot', 'text'])
+
 
 class Bot:
     """
     The AIML bot.
     """
 
-    _max_history_size = 10  # maximum length of the _inputs and _responses lists
+    _max_history_size = 10  # maximum length of the input and output histories
     _max_recursion_depth = 100  # maximum number of recursive <srai>/<sr> tags before the response is aborted.
+    _max_cache_size = 4096  # maximum number of memoized responses.
+    # The version of the categories cached for AIML files. Increment it
+    # whenever the parser's output changes, so files are parsed again.
+    _category_cache_version = 1
+
+    # The <star/> element implied by atomic <sr/>, <person/> and <person2/>
+    # elements. It's shared, so its attributes are read-only.
+    _IMPLICIT_STAR = ('star', types.MappingProxyType({}))
+
+    # The function that processes each AIML element, keyed by the element's
+    # name. Filled in by _build_handlers(), for Bot and for each subclass.
+    _HANDLERS = {}
 
-    def __init__(self, brain_file: str = None, learn=None, commands=None, verbose: bool = True) -> None:
+    def __init__(self, brain_file: str = None, learn=None, commands=None, verbose: bool = True,
+                 cache_dir: str = None) -> None:
         self._verbose_mode = verbose
+        # If a cache directory is given, the categories parsed from each AIML
+        # file are pickled there, and reused until the file changes.
+        self._cache_dir = os.path.abspath(os.path.expanduser(cache_dir)) if cache_dir else None
         self._brain = PatternManager()
-        self._respond_lock = threading.RLock()
+        self._brain_lock = threading.Lock()  # held while the brain is modified or saved
         self._text_encoding = DEFAULT_ENCODING
 
+        # Memoized responses, keyed by (subbed input, subbed that, topic), and
+        # whether each template is cacheable, keyed by the template's id.
+        self._response_cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()  # sessions share the response cache
+        # Incremented whenever the memoized responses are discarded, so a
+        # response computed before then isn't memoized afterward.
+        self._cache_generation = 0
+        self._cacheable_templates = {}
+
+        # The precomputed responses of templates that contain only constant
+        # elements (or None for other templates), keyed by the template's id.
+        self._constant_templates = {}
+
+        # The <li> branches of each <condition> element, keyed by the
+        # element's id.
+        self._condition_indexes = {}
+
         # set up the sessions        
         self._sessions = {}
         self.add_session(DEFAULT_SESSION_ID)
@@ -92,7 +143,9 @@ class Bot:
         """
         loaded_brain = False
 
-        start = time.clock()
+        verbose = self._verbose_mode
+        if verbose:
+            start = time.perf_counter()
         if brain_file and os.path.isfile(brain_file):
             self.load_brain(brain_file)
             loaded_brain = True
@@ -119,9 +172,9 @@ class Bot:
             commands = [commands]
         for cmd in commands:
             print(self._respond(cmd, DEFAULT_SESSION_ID))
-            
-        if self._verbose_mode:
-            print("Bot bootstrap completed in %.2f seconds" % (time.clock() - start))
+
+        if verbose:
+            print("Bot bootstrap completed in %.2f seconds" % (time.perf_counter() - start))
 
     @property
     def name(self) -> str:
@@ -131,8 +184,7 @@ class Bot:
     @name.setter
     def name(self, value: str) -> None:
         """The name of the bot."""
-        self._bot_predicates['name'] = value
-        self._brain.bot_name = value
+        self.set_bot_predicate('name', value)
 
     @property
     def verbose(self) -> bool:
@@ -165,9 +217,15 @@ class Bot:
         # there's a one-to-one mapping between templates and categories
         return self._brain.template_count
 
+    @property
+    def brain_modified(self) -> bool:
+        """Whether the brain has changed since it was last loaded or saved."""
+        return self._brain.modified
+
     def reset_brain(self) -> None:
         """Reset the brain to its initial state."""
         self._brain = PatternManager()
+        self._clear_caches()
 
     def load_brain(self, filename: str) -> None:
         """Attempt to load a previously-saved 'brain' from the
@@ -175,22 +233,33 @@ class Bot:
 
         NOTE: the current contents of the 'brain' will be discarded!
         """
-        if self._verbose_mode:
+        verbose = self._verbose_mode
+        if verbose:
             print("Loading brain from %s..." % filename,)
-        start = time.clock()
+            start = time.perf_counter()
         self._brain.restore(filename)
-        if self._verbose_mode:
-            end = time.clock() - start
+        self._clear_caches()
+        if verbose:
+            end = time.perf_counter() - start
             print("done (%d categories in %.2f seconds)" % (self._brain.template_count, end))
 
-    def save_brain(self, filename: str) -> None:
-        """Dump the contents of the bot's brain to a file on disk."""
-        if self._verbose_mode:
-            print("Saving brain to %s..." % filename,)
-        start = time.clock()
-        self._brain.save(filename)
-        if self._verbose_mode:
-            print("done (%.2f seconds)" % (time.clock() - start))
+    def save_brain(self, filename: str, protocol: int = pickle.HIGHEST_PROTOCOL, verbose: bool = None) -> None:
+        """Dump the contents of the bot's brain to a file on disk, using
+        the given pickle protocol. Progress is reported if verbose is set,
+        which defaults to the bot's verbose mode.
+
+        This is safe to call from a background thread; learning is held
+        off until the save completes, so the brain isn't modified mid-write.
+        """
+        if verbose is None:
+            verbose = self._verbose_mode
+        with self._brain_lock:
+            if verbose:
+                print("Saving brain to %s..." % filename,)
+                start = time.perf_counter()
+            self._brain.save(filename, protocol)
+            if verbose:
+                print("done (%.2f seconds)" % (time.perf_counter() - start))
 
     def get_predicate(self, name: str, session_id: str = None) -> str:
         """Retrieve the current value of the predicate 'name' from the
@@ -202,7 +271,7 @@ class Bot:
         assert name not in (INPUT_STACK, INPUT_HISTORY, OUTPUT_HISTORY)
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
-        return self._sessions[session_id].get(name, '')
+        return self._sessions[session_id].predicates.get(name, '')
 
     def set_predicate(self, name: str, value: object, session_id: str = None) -> None:
         """Set the value of the predicate 'name' in the specified
@@ -215,50 +284,44 @@ class Bot:
         assert name not in (INPUT_STACK, INPUT_HISTORY, OUTPUT_HISTORY)
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
-        self.add_session(session_id)  # add the session, if it doesn't already exist.
-        self._sessions[session_id][name] = value
+        # add the session, if it doesn't already exist.
+        self._get_session(session_id).predicates[sys.intern(name)] = value
 
-    def get_input_history(self, session_id: str = None) -> list:
+    def get_input_history(self, session_id: str = None) -> collections.deque:
         """Get the input history for the given session."""
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
-        self.add_session(session_id)
-        return self._sessions[session_id][INPUT_HISTORY]
+        return self._get_session(session_id).input_history
 
     def set_input_history(self, history: list, session_id: str = None) -> None:
         """Set the input history for the given session."""
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
-        self.add_session(session_id)
-        self._sessions[session_id][INPUT_HISTORY] = history
+        self._get_session(session_id).input_history = collections.deque(history, self._max_history_size)
 
-    def get_output_history(self, session_id: str = None) -> list:
+    def get_output_history(self, session_id: str = None) -> collections.deque:
         """Get the output history for the given session."""
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
-        self.add_session(session_id)
-        return self._sessions[session_id][OUTPUT_HISTORY]
+        return self._get_session(session_id).output_history
 
     def set_output_history(self, history: list, session_id: str = None) -> None:
         """Set the output history for the given session."""
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
-        self.add_session(session_id)
-        self._sessions[session_id][OUTPUT_HISTORY] = history
+        self._get_session(session_id).output_history = collections.deque(history, self._max_history_size)
 
     def get_input_stack(self, session_id: str = None) -> list:
         """Get the input stack for the given session."""
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
-        self.add_session(session_id)
-        return self._sessions[session_id][INPUT_STACK]
+        return self._get_session(session_id).input_stack
 
     def set_input_stack(self, stack: list, session_id: str = None) -> None:
         """Set the input stack for the given session."""
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
-        self.add_session(session_id)
-        self._sessions[session_id][INPUT_STACK] = stack
+        self._get_session(session_id).input_stack = stack
 
     def get_bot_predicate(self, name: str) -> str:
         """Retrieve the value of the specified bot predicate."""
@@ -269,7 +332,9 @@ class Bot:
 
         If name is not a valid bot predicate, it will be created.
         """
-        self._bot_predicates[name] = value
+        self._bot_predicates[sys.intern(name)] = value
+        self._clear_responses()
+        self._constant_templates.clear()
         # Clumsy hack: if updating the bot name, we must update the
         # name in the brain as well
         if name == "name":
@@ -287,26 +352,25 @@ class Bot:
         parser = ConfigParser()
         parser.read(filename)
         for s in parser.sections():
-            # Add a new WordSub instance for this section.  If one already
-            # exists, delete it.
-            if s in self._subbers:
-                del(self._subbers[s])
-            self._subbers[s] = WordSub()
-            # iterate over the key,value pairs and add them to the subber
-            for key, v in parser.items(s):
-                self._subbers[s][key] = v
+            # Add a new WordSub instance for this section, holding its
+            # key,value pairs.  If one already exists, it's replaced.
+            self._subbers[s] = WordSub(parser.items(s))
+        self._clear_responses()
+        for session in self._sessions.values():
+            session.subbed_input = session.subbed_that = session.subbed_topic = ('', '')
 
     def add_session(self, session_id: str) -> None:
         """Create a new session with the specified ID string."""
-        # Create the session.
-        if session_id in self._sessions:
-            session_data = self._sessions[session_id]
-        else:
-            session_data = self._sessions[session_id] = {}
-        # Initialize the special reserved predicates
-        for key in INPUT_HISTORY, OUTPUT_HISTORY, INPUT_STACK:
-            if key not in session_data:
-                session_data[key] = []
+        self._get_session(session_id)
+
+    def _get_session(self, session_id: str) -> Session:
+        """Return the session with the specified ID string, creating it
+        if it doesn't already exist."""
+        session = self._sessions.get(session_id)
+        if session is None:
+            # setdefault() keeps two threads from creating the same session.
+            session = self._sessions.setdefault(session_id, Session(self._max_history_size))
+        return session
 
     def delete_session(self, session_id: str):
         """Delete the specified session."""
@@ -319,8 +383,13 @@ class Bot:
         """
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
-        self.add_session(session_id)
-        return copy.deepcopy(self._sessions[session_id])
+        session = self._get_session(session_id)
+        # Predicate values are strings, so only the lists need copying.
+        data = dict(session.predicates)
+        data[INPUT_HISTORY] = list(session.input_history)
+        data[OUTPUT_HISTORY] = list(session.output_history)
+        data[INPUT_STACK] = list(session.input_stack)
+        return data
 
     def set_session_data(self, data: dict, session_id: str = None) -> None:
         """
@@ -328,7 +397,13 @@ class Bot:
         """
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
-        self._sessions[session_id] = data
+        data = dict(data)
+        session = Session(self._max_history_size)
+        session.input_history.extend(data.pop(INPUT_HISTORY, ()))
+        session.output_history.extend(data.pop(OUTPUT_HISTORY, ()))
+        session.input_stack = data.pop(INPUT_STACK, [])
+        session.predicates = data
+        self._sessions[session_id] = session
 
     def learn(self, filename: str) -> None:
         """Load and learn the contents of the specified AIML file.
@@ -337,34 +412,167 @@ class Bot:
         will be loaded and learned.
         """
 
+        filename = os.path.expanduser(filename)
         filenames = [filename]
         if filename != os.path.join(AIML_INSTALL_PATH, filename):
             filenames.append(os.path.join(AIML_INSTALL_PATH, filename))
         filenames += [filename.lower() for filename in filenames]
 
-        for filename in filenames:
-            for f in glob.glob(filename):
-                if not os.path.isfile(f):
-                    continue  # Skip folders.
-                if self._verbose_mode:
-                    print("Loading %s..." % f,)
-                start = time.clock()
-                # Load and parse the AIML file.
-                parser = create_parser()
-                handler = parser.getContentHandler()
-                handler.setEncoding(self._text_encoding)
-                try:
-                    parser.parse(f)
-                except xml.sax.SAXParseException as msg:
-                    err = "\nFATAL PARSE ERROR in file %s:\n%s\n" % (f, msg)
-                    sys.stderr.write(err)
-                    continue
-                # store the pattern/template pairs in the PatternManager.
-                for key, tem in handler.categories.items():
-                    self._brain.add(*key, tem)
-                # Parsing was successful.
-                if self._verbose_mode:
-                    print("done (%.2f seconds)" % (time.clock() - start))
+        # Several of the names can match the same file, e.g. on a
+        # case-insensitive file system, so files are identified by device
+        # and inode to make sure each one is only learned once.
+        seen = set()
+        verbose = self._verbose_mode
+        # One parser is shared by all the files learned here. It isn't
+        # shared with other calls, since <learn> elements in different
+        # sessions can learn files at the same time, and a SAX parser can
+        # only parse one file at a time.
+        parser = None
+        learned = []  # the categories of each file, in order
+        try:
+            for filename in dict.fromkeys(filenames):
+                for f in glob.glob(filename):
+                    try:
+                        info = os.stat(f)
+                    except OSError:
+                        continue
+                    if not stat.S_ISREG(info.st_mode):
+                        continue  # Skip folders.
+                    if (info.st_dev, info.st_ino) in seen:
+                        continue
+                    seen.add((info.st_dev, info.st_ino))
+                    if verbose:
+                        print("Loading %s..." % f,)
+                        start = time.perf_counter()
+                    # Use the cached categories if the file hasn't changed.
+                    categories = cache_path = cache_stamp = None
+                    if self._cache_dir is not None:
+                        cache_path = self._get_cache_path(f)
+                        cache_stamp = self._get_cache_stamp(info)
+                        categories = self._load_cached_categories(cache_path, cache_stamp)
+                    if categories is None:
+                        # Load and parse the AIML file.
+                        if parser is None:
+                            parser = create_parser()
+                        handler = AimlHandler(self._text_encoding)
+                        parser.setContentHandler(handler)
+                        try:
+                            with open(f, 'rb') as file:
+                                parser.parse(file)
+                        except xml.sax.SAXParseException as msg:
+                            err = "\nFATAL PARSE ERROR in file %s:\n%s\n" % (f, msg)
+                            sys.stderr.write(err)
+                            continue
+                        categories = handler.categories
+                        if cache_path is not None:
+                            self._save_cached_categories(cache_path, cache_stamp, categories)
+                    learned.append(categories.items())
+                    # Parsing was successful.
+                    if verbose:
+                        print("done (%.2f seconds)" % (time.perf_counter() - start))
+        finally:
+            # Store the pattern/template pairs in the PatternManager all at
+            # once, so the brain's compiled form is only brought up to date
+            # once. If a file fails to parse, the files before it are still
+            # learned.
+            if learned:
+                with self._brain_lock:
+                    self._brain.add_many(itertools.chain.from_iterable(learned))
+                self._clear_caches()
+
+    def _get_cache_path(self, filename: str) -> str:
+        """Return the path of the cached categories for an AIML file. The
+        name is a hash of the file's path, so each file has only one cache
+        entry, which is replaced whenever the file is parsed again."""
+        digest = hashlib.blake2b(os.path.realpath(filename).encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self._cache_dir, digest + '.pkl')
+
+    def _get_cache_stamp(self, info: os.stat_result) -> tuple:
+        """Return a tuple of everything that affects the categories parsed
+        from an AIML file, which is stored with them in the cache."""
+        return self._category_cache_version, info.st_mtime_ns, info.st_size, self._text_encoding
+
+    @staticmethod
+    def _load_cached_categories(cache_path: str, cache_stamp: tuple):
+        """Return the categories stored at the given cache path, or None if
+        they aren't available, or are out of date."""
+        # A cache entry written by another version can fail to load in all
+        # sorts of ways; whatever goes wrong, the file is just parsed again.
+        # noinspection PyBroadException
+        try:
+            with open(cache_path, 'rb') as file:
+                stamp, categories = pickle.load(file)
+        except Exception:
+            return None
+        if stamp != cache_stamp or not isinstance(categories, dict):
+            return None
+        return categories
+
+    def _save_cached_categories(self, cache_path: str, cache_stamp: tuple, categories: dict) -> None:
+        """Store parsed categories in the cache. Failing to write the cache
+        isn't an error; the file will just be parsed again next time."""
+        temp_path = cache_path + '.tmp'
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with open(temp_path, 'wb') as file:
+                pickle.dump((cache_stamp, categories), file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+        except OSError as error:
+            if self._verbose_mode:
+                sys.stderr.write("WARNING: unable to cache %s: %s\n" % (cache_path, error))
+
+    def _clear_responses(self) -> None:
+        """Discard memoized responses. This must be called whenever
+        anything a memoized response depends on changes."""
+        with self._cache_lock:
+            self._response_cache.clear()
+            self._cache_generation += 1
+
+    def _clear_caches(self) -> None:
+        """Discard memoized responses and everything computed from the
+        templates. This must be called whenever the brain changes."""
+        self._clear_responses()
+        self._cacheable_templates.clear()
+        self._constant_templates.clear()
+        self._condition_indexes.clear()
+
+    def _is_cacheable(self, template: list) -> bool:
+        """Return whether the response generated by a template can be
+        memoized. The result is computed once per template."""
+        entry = self._cacheable_templates.get(id(template))
+        # The template is kept in the entry, so its id can't be reused.
+        if entry is None or entry[0] is not template:
+            entry = (template, self._is_cacheable_element(template))
+            self._cacheable_templates[id(template)] = entry
+        return entry[1]
+
+    def _get_constant_response(self, template: list):
+        """Return the response generated by a template containing only
+        constant elements, or None if the template's response can vary.
+        The response is computed once per template."""
+        entry = self._constant_templates.get(id(template))
+        # The template is kept in the entry, so its id can't be reused.
+        if entry is None or entry[0] is not template:
+            generation = self._cache_generation
+            response = None
+            if template[0] == 'template' and all(e[0] in CONSTANT_ELEMENTS for e in template[2:]):
+                response = self._process_element(template, DEFAULT_SESSION_ID).strip()
+            # If the bot predicates changed in the meantime, the response may
+            # be out of date already, so it's only stored if they haven't.
+            with self._cache_lock:
+                if self._cache_generation == generation:
+                    self._constant_templates[id(template)] = (template, response)
+            return response
+        return entry[1]
+
+    def _is_cacheable_element(self, element: list) -> bool:
+        """Return whether an element and all of its children are free of
+        side effects and depend only on the memoization key."""
+        if element[0] not in CACHEABLE_ELEMENTS:
+            return False
+        if element[0] == 'text':
+            return True
+        return all(self._is_cacheable_element(e) for e in element[2:])
 
     def respond(self, text: str, session_id: str = None) -> str:
         """Return the Bot's response to the input string."""
@@ -374,46 +582,33 @@ class Bot:
         if session_id is None:
             session_id = DEFAULT_SESSION_ID
 
-        # prevent other threads from stomping all over us.
-        self._respond_lock.acquire()
-
         # Add the session, if it doesn't already exist
-        self.add_session(session_id)
+        session = self._get_session(session_id)
 
         # split the input into discrete sentences
         sentences = split_sentences(text)
-        final_response = ""
-        for s in sentences:
-            # Add the input to the history list before fetching the
-            # response, so that <input/> tags work properly.
-            input_history = self.get_input_history(session_id)
-            if not isinstance(input_history, list):
-                input_history = []
-            input_history.append(s)
-            while len(input_history) > self._max_history_size:
-                input_history.pop(0)
-            self.set_input_history(input_history, session_id)
-            
-            # Fetch the response
-            response = self._respond(s, session_id)
-
-            # add the data from this exchange to the history lists
-            output_history = self.get_output_history(session_id)
-            if not isinstance(output_history, list):
-                output_history = []
-            output_history.append(response)
-            while len(output_history) > self._max_history_size:
-                output_history.pop(0)
-            self.set_output_history(output_history, session_id)
-
-            # append this response to the final response.
-            final_response += (response + "  ")
-        final_response = final_response.strip()
-
-        assert not self.get_input_stack(session_id)
-
-        # release the lock and return
-        self._respond_lock.release()
+        responses = []
+
+        # prevent other threads from stomping all over this session.
+        # Other sessions can respond in parallel.
+        with session.lock:
+            for s in sentences:
+                # Add the input to the history list before fetching the
+                # response, so that <input/> tags work properly.
+                session.input_history.append(s)
+
+                # Fetch the response
+                response = self._respond(s, session_id)
+
+                # add the data from this exchange to the history lists
+                session.output_history.append(response)
+
+                # append this response to the final response.
+                responses.append(response)
+            final_response = "  ".join(responses).strip()
+
+            assert not session.input_stack
+
         return final_response
 
     # This version of _respond() just fetches the response for some input.
@@ -425,33 +620,51 @@ class Bot:
         if not text:
             return ""
 
+        session = self._get_session(session_id)
+
         # guard against infinite recursion
-        input_stack = self.get_input_stack(session_id)
+        input_stack = session.input_stack
         if len(input_stack) > self._max_recursion_depth:
             if self._verbose_mode:
                 err = "WARNING: maximum recursion depth exceeded (input='%s')" % text
                 sys.stderr.write(err)
             return ""
 
-        # push the input onto the input stack
-        input_stack.append(text)
-        self.set_input_stack(input_stack, session_id)
-
         # run the input through the 'normal' subber
-        subbed_input = self._subbers['normal'].sub(text)
+        if text != session.subbed_input[0]:
+            session.subbed_input = (text, self._subbers['normal'].sub(text))
+        subbed_input = session.subbed_input[1]
 
         # fetch the bot's previous response, to pass to the match()
-        # function as 'that'.
-        output_history = self.get_output_history(session_id)
+        # function as 'that'. The substituted forms of 'that' and the topic
+        # are cached on the session, since they rarely change between calls.
+        output_history = session.output_history
         if output_history:
             that = output_history[-1]
         else:
             that = ""
-        subbed_that = self._subbers['normal'].sub(that)
+        if that != session.subbed_that[0]:
+            session.subbed_that = (that, self._subbers['normal'].sub(that))
+        subbed_that = session.subbed_that[1]
 
         # fetch the current topic
-        topic = self.get_predicate("topic", session_id)
-        subbed_topic = self._subbers['normal'].sub(topic)
+        topic = session.predicates.get("topic", "")
+        if topic != session.subbed_topic[0]:
+            session.subbed_topic = (topic, self._subbers['normal'].sub(topic))
+        subbed_topic = session.subbed_topic[1]
+
+        # Check for a memoized response. The raw topic is part of the key
+        # because <topicstar> extracts its words from the unsubstituted topic.
+        cache_key = (subbed_input, subbed_that, topic)
+        with self._cache_lock:
+            response = self._response_cache.get(cache_key)
+            if response is not None:
+                self._response_cache.move_to_end(cache_key)
+                return response
+            generation = self._cache_generation
+
+        # push the input onto the input stack
+        input_stack.append(text)
 
         # Determine the final response.
         response = ""
@@ -461,18 +674,43 @@ class Bot:
                 err = "WARNING: No match found for input: %s\n" % text
                 sys.stderr.write(err)
         else:
-            # Process the element into a response string.
-            response += self._process_element(elem, session_id).strip()
-            response += " "
-        response = response.strip()
+            # Templates that always say the same thing skip processing.
+            response = self._get_constant_response(elem)
+            if response is None:
+                # Process the element into a response string.
+                response = self._process_element(elem, session_id).strip()
 
         # pop the top entry off the input stack.
-        input_stack = self.get_input_stack(session_id)
         input_stack.pop()
-        self.set_input_stack(input_stack, session_id)
-        
+
+        # Memoize the response if the template has no side effects and
+        # doesn't depend on anything outside the cache key. If the memoized
+        # responses were discarded in the meantime (e.g. by another thread
+        # learning new categories), this one may be out of date already.
+        if elem is not None and self._is_cacheable(elem):
+            with self._cache_lock:
+                if self._cache_generation != generation:
+                    return response
+                self._response_cache[cache_key] = response
+                if len(self._response_cache) > self._max_cache_size:
+                    self._response_cache.popitem(last=False)
+
         return response
 
+    def _get_star_context(self, session: Session) -> tuple:
+        """Return the input and 'that' after the 'normal' substitutions, and
+        the raw topic, which <star>, <thatstar> and <topicstar> elements
+        extract their words from. The substituted forms are cached on the
+        session, since a template often has several of these elements."""
+        text = session.input_stack[-1]
+        if text != session.subbed_input[0]:
+            session.subbed_input = (text, self._subbers['normal'].sub(text))
+        output_history = session.output_history
+        that = output_history[-1] if output_history else ''  # there might not be any output yet
+        if that != session.subbed_that[0]:
+            session.subbed_that = (that, self._subbers['normal'].sub(that))
+        return session.subbed_input[1], session.subbed_that[1], session.predicates.get("topic", "")
+
     def _process_element(self, element: list, session_id: str) -> str:
         """Process an AIML element.
 
@@ -483,16 +721,19 @@ class Bot:
         element's begin and end tags; they are handled by each
         element's handler function.
         """
-        element_name = element[0]
-        handler_name = '_process_' + element_name
-        handler = getattr(self, handler_name, None)
+        handler = self._HANDLERS.get(element[0])
         if handler is None:
             # Oops -- there's no handler function for this element type!
             if self._verbose_mode:
                 err = "WARNING: No handler found for <%s> element\n" % element[0]
                 sys.stderr.write(err)
             return ""
-        return handler(element, session_id)
+        return handler(self, element, session_id)
+
+    def _process_children(self, element: list, session_id: str) -> str:
+        """Process the contents of an AIML element, and return the
+        concatenated results."""
+        return ''.join([self._process_element(e, session_id) for e in element[2:]])
 
     ##################################################
     # Individual element-processing functions follow #
@@ -541,7 +782,6 @@ class Bot:
         last entry) must now include both 'name' and 'value'
         attributes.
         """        
-        response = ""
         attributes = element[1]
         name = attributes.get('name', None)
         value = attributes.get('value', None)
@@ -550,73 +790,101 @@ class Bot:
         # specific value.
         if name is not None and value is not None:
             if self.get_predicate(name, session_id) == value:
-                for e in element[2:]:
-                    response += self._process_element(e, session_id)
-                return response
+                return self._process_children(element, session_id)
+        else:
+            # Case #2 and #3: Find the first <li> whose name and value pair
+            # matches, falling back on the default <li>, if there is one.
+            index = self._index_condition(element)
+            if index is None:
+                # An <li> is missing its name or value attribute. The <li>
+                # elements are tested one by one, so the error is only
+                # raised if none of the ones before it match.
+                li = self._scan_condition(element, name, session_id)
+                return "" if li is None else self._process_element(li, session_id)
+            branches, value_map, default_li = index
+            if name is not None:
+                # Case #2: every <li> tests the same predicate, so its
+                # value can be looked up directly.
+                predicate = self.get_predicate(name, session_id)
+                li = value_map.get(predicate) if isinstance(predicate, str) else None
+            else:
+                # Case #3: each <li> tests its own predicate.
+                li = None
+                for li_name, li_value, item in branches:
+                    if self.get_predicate(li_name, session_id) == li_value:
+                        li = item
+                        break
+            if li is None:
+                li = default_li
+            if li is not None:
+                return self._process_element(li, session_id)
+        return ""
+
+    def _index_condition(self, element: list) -> tuple:
+        """Return a tuple (branches, value_map, default_li) describing the
+        <li> elements of a <condition> element without both a 'name' and a
+        'value' attribute, or None if any of them lacks an attribute it
+        needs, in which case _scan_condition() must be used instead.
+
+        branches is a list of (name, value, li) tuples, in order.
+        value_map maps each value to the first <li> that tests for it.
+        default_li is the last <li> element if it has no attributes, and
+        None otherwise.
+
+        The index is computed once per element, since the element tree
+        doesn't change once it has been learned.
+        """
+        entry = self._condition_indexes.get(id(element))
+        # The element is kept in the entry, so its id can't be reused.
+        if entry is not None and entry[0] is element:
+            return entry[1]
+        name = element[1].get('name', None)
+        list_items = [e for e in element[2:] if e[0] == 'li']
+        default_li = None
+        if list_items and not list_items[-1][1]:
+            default_li = list_items.pop()
+        try:
+            branches = [(li[1]['name'] if name is None else name, li[1]['value'], li) for li in list_items]
+        except KeyError:
+            index = None
         else:
-            # Case #2 and #3: Cycle through <li> contents, testing a
-            # name and value pair for each one.
+            value_map = {}
+            for li_name, li_value, li in branches:
+                value_map.setdefault(li_value, li)
+            index = (branches, value_map, default_li)
+        self._condition_indexes[id(element)] = (element, index)
+        return index
+
+    def _scan_condition(self, element: list, name: str, session_id: str):
+        """Return the first <li> element of a <condition> element whose
+        name and value pair matches, or the last <li> element if none does
+        and it has no attributes, or None. The name is the condition's
+        'name' attribute, if it has one.
+
+        A KeyError is raised on reaching an <li> element without the
+        attributes it needs.
+        """
+        list_items = [e for e in element[2:] if e[0] == 'li']
+        for index, li in enumerate(list_items):
+            attributes = li[1]
+            # if this is the last list item, it's allowed to have no
+            # attributes, and is the default.
+            if not attributes and index + 1 == len(list_items):
+                return li
             try:
-                # Get the list of <li> elements
-                list_items = []
-                for e in element[2:]:
-                    if e[0] == 'li':
-                        list_items.append(e)
-                # if list_items is empty, return the empty string
-                if not list_items:
-                    return ""
-                # iterate through the list looking for a condition that
-                # matches.
-                found_match = False
-                for index, li in enumerate(list_items):
-                    try:
-                        li_attributes = li[1]
-                        # if this is the last list item, it's allowed
-                        # to have no attributes.  We just skip it for now.
-                        if not li_attributes and index + 1 == len(list_items):
-                            break
-                        # get the name of the predicate to test
-                        li_name = name
-                        if li_name is None:
-                            li_name = li_attributes['name']
-                        # get the value to check against
-                        li_value = li_attributes['value']
-                        # do the test
-                        if self.get_predicate(li_name, session_id) == li_value:
-                            found_match = True
-                            response += self._process_element(li, session_id)
-                            break
-                    except:
-                        # No attributes, no name/value attributes, no
-                        # such predicate/session, or processing error.
-                        if self._verbose_mode:
-                            print("Something amiss -- skipping list item", li)
-                        raise
-                if not found_match:
-                    # Check the last element of list_items.  If it has
-                    # no 'name' or 'value' attribute, process it.
-                    try:
-                        li = list_items[-1]
-                        li_attributes = li[1]
-                        if not ('name' in li_attributes or 'value' in li_attributes):
-                            response += self._process_element(li, session_id)
-                    except:
-                        # list_items was empty, no attributes, missing
-                        # name/value attributes, or processing error.
-                        if self._verbose_mode:
-                            print("error in default list item")
-                        raise
-            except Exception:
-                # Some other catastrophic cataclysm
+                li_name = attributes['name'] if name is None else name
+                li_value = attributes['value']
+            except KeyError:
                 if self._verbose_mode:
-                    print("catastrophic condition failure")
+                    print("Something amiss -- invalid list item", li)
                 raise
-        return response
-        
+            if self.get_predicate(li_name, session_id) == li_value:
+                return li
+        return None
+
     # <date>
-    # noinspection PyUnusedLocal
-    @staticmethod
-    def _process_date(element: list, session_id: str) -> str:
+    # noinspection PyUnusedLocal,PyMethodMayBeStatic
+    def _process_date(self, element: list, session_id: str) -> str:
         """Process a <date> AIML element.
 
         <date> elements resolve to the current date and time.  The
@@ -632,10 +900,7 @@ class Bot:
         <formal> elements process their contents recursively, and then
         capitalize the first letter of each word of the result.
         """                
-        response = ""
-        for e in element[2:]:
-            response += self._process_element(e, session_id)
-        return string.capwords(response)
+        return string.capwords(self._process_children(element, session_id))
 
     # <gender>
     def _process_gender(self, element: list, session_id: str) -> str:
@@ -645,10 +910,7 @@ class Bot:
         gender of any third-person singular pronouns in the result.
         This substitution is handled by the aiml.WordSub module.
         """
-        response = ""
-        for e in element[2:]:
-            response += self._process_element(e, session_id)
-        return self._subbers['gender'].sub(response)
+        return self._subbers['gender'].sub(self._process_children(element, session_id))
 
     # <get>
     def _process_get(self, element: list, session_id: str) -> str:
@@ -677,9 +939,8 @@ class Bot:
         return self._process_think(element, session_id)
 
     # <id>
-    # noinspection PyUnusedLocal
-    @staticmethod
-    def _process_id(element: list, session_id: str) -> str:
+    # noinspection PyUnusedLocal,PyMethodMayBeStatic
+    def _process_id(self, element: list, session_id: str) -> str:
         """ Process an <id> AIML element.
 
         <id> elements return a unique "user id" for a specific
@@ -701,7 +962,7 @@ class Bot:
         the current session.
         """        
         index = int(element[1].get('index', 1))
-        input_history = self.get_input_history(session_id)
+        input_history = self._get_session(session_id).input_history
         if len(input_history) >= index:
             return input_history[-index]
         else:
@@ -730,10 +991,7 @@ class Bot:
         <learn> elements process their contents recursively, and then
         treat the result as an AIML file to open and learn.
         """
-        filename = ""
-        for e in element[2:]:
-            filename += self._process_element(e, session_id)
-        self.learn(filename)
+        self.learn(self._process_children(element, session_id))
         return ""
 
     # <li>
@@ -749,10 +1007,7 @@ class Bot:
         <random> elements.  See _processCondition() and
         _processRandom() for details of their usage.
         """
-        response = ""
-        for e in element[2:]:
-            response += self._process_element(e, session_id)
-        return response
+        return self._process_children(element, session_id)
 
     # <lowercase>
     def _process_lowercase(self, element: list, session_id: str) -> str:
@@ -761,10 +1016,7 @@ class Bot:
         <lowercase> elements process their contents recursively, and
         then convert the results to all-lowercase.
         """
-        response = ""
-        for e in element[2:]:
-            response += self._process_element(e, session_id)
-        return response.lower()
+        return self._process_children(element, session_id).lower()
 
     # <person>
     def _process_person(self, element: list, session_id: str) -> str:
@@ -778,11 +1030,10 @@ class Bot:
         If the <person> tag is used atomically (e.g. <person/>), it is
         a shortcut for <person><star/></person>.
         """
-        response = ""
-        for e in element[2:]:
-            response += self._process_element(e, session_id)
         if len(element) <= 2:  # atomic <person/> = <person><star/></person>
-            response = self._process_element(['star', {}], session_id)
+            response = self._process_element(self._IMPLICIT_STAR, session_id)
+        else:
+            response = self._process_children(element, session_id)
         return self._subbers['person'].sub(response)
 
     # <person2>
@@ -797,11 +1048,10 @@ class Bot:
         If the <person2> tag is used atomically (e.g. <person2/>), it is
         a shortcut for <person2><star/></person2>.
         """
-        response = ""
-        for e in element[2:]:
-            response += self._process_element(e, session_id)
         if len(element) <= 2:  # atomic <person2/> = <person2><star/></person2>
-            response = self._process_element(['star', {}], session_id)
+            response = self._process_element(self._IMPLICIT_STAR, session_id)
+        else:
+            response = self._process_children(element, session_id)
         return self._subbers['person2'].sub(response)
         
     # <random>
@@ -833,10 +1083,7 @@ class Bot:
         <sentence> elements process their contents recursively, and
         then capitalize the first letter of the results.
         """
-        response = ""
-        for e in element[2:]:
-            response += self._process_element(e, session_id)
-        response = response.strip()
+        response = self._process_children(element, session_id).strip()
         return response[:1].upper() + response[1:]
 
     # <set>
@@ -850,9 +1097,7 @@ class Bot:
         (given by their 'name' attribute) in the current session.  The contents of the element
         are also returned.
         """
-        value = ""
-        for e in element[2:]:
-            value += self._process_element(e, session_id)
+        value = self._process_children(element, session_id)
         self.set_predicate(element[1]['name'], value, session_id)
         return value
 
@@ -873,7 +1118,7 @@ class Bot:
 
         <sr> elements are shortcuts for <srai><star/></srai>.
         """
-        star = self._process_element(['star', {}], session_id)
+        star = self._process_element(self._IMPLICIT_STAR, session_id)
         return self._respond(star, session_id)
 
     # <srai>
@@ -885,10 +1130,7 @@ class Bot:
         piece of input.  The results of this new input string are
         returned.
         """
-        new_input = ""
-        for e in element[2:]:
-            new_input += self._process_element(e, session_id)
-        return self._respond(new_input, session_id)
+        return self._respond(self._process_children(element, session_id), session_id)
 
     # <star>
     def _process_star(self, element: list, session_id: str) -> str:
@@ -905,16 +1147,7 @@ class Bot:
         would evaluate to "Tom Smith".
         """
         index = int(element[1].get('index', 1))
-        # fetch the user's last input
-        input_stack = self.get_input_stack(session_id)
-        text_input = self._subbers['normal'].sub(input_stack[-1])
-        # fetch the Bot's last response (for 'that' context)
-        output_history = self.get_output_history(session_id)
-        if output_history:
-            that = self._subbers['normal'].sub(output_history[-1])
-        else:
-            that = ''  # there might not be any output yet
-        topic = self.get_predicate("topic", session_id)
+        text_input, that, topic = self._get_star_context(self._get_session(session_id))
         return self._brain.star("star", text_input, that, topic, index)
 
     # <system>
@@ -931,9 +1164,7 @@ class Bot:
         directory separator.
         """
         # build up the command string
-        command = ""
-        for e in element[2:]:
-            command += self._process_element(e, session_id)
+        command = self._process_children(element, session_id)
 
         # normalize the path to the command.  Under Windows, this
         # switches forward-slashes to back-slashes; all system
@@ -944,20 +1175,15 @@ class Bot:
         #command = executable + " " + args
         command = os.path.normpath(command)
 
-        # execute the command.
-        response = ""
+        # execute the command, and wait for all of its output.
         try:
-            out = os.popen(command)            
-        except RuntimeError as msg:
+            result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+        except (OSError, subprocess.SubprocessError) as msg:
             if self._verbose_mode:
-                err = "WARNING: RuntimeError while processing \"system\" element:\n%s\n" % str(msg)
+                err = "WARNING: %s while processing \"system\" element:\n%s\n" % (type(msg).__name__, msg)
                 sys.stderr.write(err)
             return "There was an error while computing my response.  Please inform my botmaster."
-        time.sleep(0.01)  # I'm told this works around a potential IOError exception.
-        for line in out:
-            response += line + "\n"
-        response = ' '.join(response.splitlines()).strip()
-        return response
+        return ' '.join(result.stdout.splitlines()).strip()
 
     # <template>
     def _process_template(self, element: list, session_id: str) -> str:
@@ -967,15 +1193,11 @@ class Bot:
         return the results.  <template> is the root node of any AIML
         response tree.
         """
-        response = ""
-        for e in element[2:]:
-            response += self._process_element(e, session_id)
-        return response
+        return self._process_children(element, session_id)
 
     # text
-    # noinspection PyUnusedLocal
-    @staticmethod
-    def _process_text(element: list, session_id: str) -> str:
+    # noinspection PyUnusedLocal,PyMethodMayBeStatic
+    def _process_text(self, element: list, session_id: str) -> str:
         """Process a raw text element.
 
         Raw text elements aren't really AIML tags. Text elements cannot contain
@@ -992,9 +1214,19 @@ class Bot:
         # space.  To improve performance, we do this only once for each
         # text element encountered, and save the results for the future.
         if element[1]["xml:space"] == "default":
-            # We can't just split and join because we need to preserve the
-            # leading and trailing spaces.
-            element[2] = re.sub('\s+', ' ', element[2])
+            # Splitting and joining is much faster than a regex, but the
+            # leading and trailing spaces have to be put back by hand.
+            text = element[2]
+            words = text.split()
+            if words:
+                collapsed = ' '.join(words)
+                if text[0].isspace():
+                    collapsed = ' ' + collapsed
+                if text[-1].isspace():
+                    collapsed += ' '
+            else:
+                collapsed = ' ' if text else ''
+            element[2] = collapsed
             element[1]["xml:space"] = "preserve"
         return element[2]
 
@@ -1011,7 +1243,7 @@ class Bot:
         are the output equivalent of <input> elements; they return one
         of the Bot's previous responses.
         """
-        output_history = self.get_output_history(session_id)
+        output_history = self._get_session(session_id).output_history
 
         index = element[1].get('index', '1')
         if ',' in index:
@@ -1055,16 +1287,7 @@ class Bot:
         "*" in the current category's <that> pattern.
         """
         index = int(element[1].get('index', 1))
-        # fetch the user's last input
-        input_stack = self.get_input_stack(session_id)
-        text_input = self._subbers['normal'].sub(input_stack[-1])
-        # fetch the Bot's last response (for 'that' context)
-        output_history = self.get_output_history(session_id)
-        if output_history:
-            that = self._subbers['normal'].sub(output_history[-1])
-        else:
-            that = ''  # there might not be any output yet
-        topic = self.get_predicate("topic", session_id)
+        text_input, that, topic = self._get_star_context(self._get_session(session_id))
         return self._brain.star("thatstar", text_input, that, topic, index)
 
     # <think>
@@ -1094,16 +1317,7 @@ class Bot:
         by a "*" in the current category's <topic> pattern.
         """
         index = int(element[1].get('index', 1))
-        # fetch the user's last input
-        input_stack = self.get_input_stack(session_id)
-        text_input = self._subbers['normal'].sub(input_stack[-1])
-        # fetch the Bot's last response (for 'that' context)
-        output_history = self.get_output_history(session_id)
-        if output_history:
-            that = self._subbers['normal'].sub(output_history[-1])
-        else:
-            that = ''  # there might not be any output yet
-        topic = self.get_predicate("topic", session_id)
+        text_input, that, topic = self._get_star_context(self._get_session(session_id))
         return self._brain.star("topicstar", text_input, that, topic, index)
 
     # <uppercase>
@@ -1114,10 +1328,7 @@ class Bot:
         return the results with all lower-case characters converted to
         upper-case.
         """
-        response = ""
-        for e in element[2:]:
-            response += self._process_element(e, session_id)
-        return response.upper()
+        return self._process_children(element, session_id).upper()
 
     # <version>
     # noinspection PyUnusedLocal
@@ -1128,3 +1339,23 @@ class Bot:
         interpreter.
         """
         return self.version
+
+    def __init_subclass__(cls, **kwargs):
+        """Build the handler table again for each subclass, so any handler
+        functions it overrides or adds are used."""
+        super().__init_subclass__(**kwargs)
+        cls._HANDLERS = _build_handlers(cls)
+
+
+def _build_handlers(cls) -> dict:
+    """Map each AIML element name to the function of the given Bot class
+    that processes it. The table is built once per class, so dispatch is a
+    single dict lookup."""
+    return {
+        name[len('_process_'):]: getattr(cls, name)
+        for name in dir(cls)
+        if name.startswith('_process_') and name not in ('_process_element', '_process_children')
+    }
+
+
+Bot._HANDLERS = _build_handlers(Bot)
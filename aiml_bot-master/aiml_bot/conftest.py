@@ -0,0 +1,11 @@
+"""pytest fixtures for the tests in tests.py."""
+
+import pytest
+
+from .tests import BotTestRun
+
+
+@pytest.fixture(scope='module')
+def bot_test_run() -> BotTestRun:
+    """The bot which the test_bot_tag cases run the BOT_TESTS on, in order."""
+    return BotTestRun()
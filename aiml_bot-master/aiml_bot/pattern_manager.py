@@ -4,13 +4,29 @@ by Dr. Richard Wallace at the following site:
 http://www.alicebot.org/documentation/matching.html
 """
 
+import gc
+import io
 import marshal
-import pprint
-import re
+import os
+import pickle
+import sys
 
 
 PUNCTUATION = "\"`~!@#$%^&*()-_=+[{]}\|;:',<.>/?"
 
+# special dictionary keys. These are module globals, rather than only class
+# attributes, so the matcher's inner loop doesn't look them up on self.
+_UNDERSCORE = 0
+_STAR = 1
+_TEMPLATE = 2
+_THAT = 3
+_TOPIC = 4
+_BOT_NAME = 5
+
+# In a compiled node, the slot holding the children keyed by word. The
+# special keys above are slots of their own.
+_WORDS = 6
+
 
 class PatternManager:
     """
@@ -20,25 +36,38 @@ class PatternManager:
     """
 
     # special dictionary keys
-    _UNDERSCORE = 0
-    _STAR = 1
-    _TEMPLATE = 2
-    _THAT = 3
-    _TOPIC = 4
-    _BOT_NAME = 5
+    _UNDERSCORE = _UNDERSCORE
+    _STAR = _STAR
+    _TEMPLATE = _TEMPLATE
+    _THAT = _THAT
+    _TOPIC = _TOPIC
+    _BOT_NAME = _BOT_NAME
+    _WORDS = _WORDS
+
+    _max_normalized_size = 1024  # maximum number of memoized normalizations
 
     def __init__(self):
         self._root = {}
+        self._compiled_root = self._compile(self._root)  # see _compile
         self._template_count = 0
         self._bot_name = "Nameless"
-        self._punctuation_re = re.compile("[" + re.escape(PUNCTUATION) + "]")
-        self._whitespace_re = re.compile("\s+")
+        self._modified = True  # Nothing has been saved or restored yet.
+        # Punctuation is translated to spaces, so it separates words.
+        self._punctuation_table = str.maketrans(PUNCTUATION, " " * len(PUNCTUATION))
+        self._normalized = {}  # recent inputs, mapped to their normalized words
+        self._last_star_match = None  # see _match_for_stars
 
     @property
     def template_count(self) -> int:
         """Return the number of templates currently stored."""
         return self._template_count
 
+    @property
+    def modified(self) -> bool:
+        """Return whether the patterns have changed since they were last
+        saved or restored."""
+        return self._modified
+
     @property
     def bot_name(self) -> str:
         return self._bot_name
@@ -48,31 +77,65 @@ class PatternManager:
         """Set the name of the bot, used to match <bot name="name"> tags in
         patterns.  The name must be a single word!"""
         # Collapse a multi-word name into a single word
-        self._bot_name = ''.join(value.split())
+        value = sys.intern(''.join(value.split()))
+        if value != self._bot_name:
+            self._bot_name = value
+            self._modified = True
 
     def dump(self) -> None:
         """Print all learned patterns, for debugging purposes."""
+        # Imported here, since pprint is slow to import and only needed
+        # for debugging.
+        import pprint
         pprint.pprint(self._root)
 
-    def save(self, filename: str) -> None:
+    def save(self, filename: str, protocol: int = pickle.HIGHEST_PROTOCOL) -> None:
         """Dump the current patterns to the file specified by filename.  To
-        restore later, use restore()."""
+        restore later, use restore().
+
+        The patterns are written to a temporary file first, which then
+        replaces the target file, so an interrupted save never leaves a
+        partially written brain behind."""
+        temp_filename = filename + ".tmp"
         try:
-            with open(filename, "wb") as file:
-                marshal.dump(self._template_count, file)
-                marshal.dump(self._bot_name, file)
-                marshal.dump(self._root, file)
+            with open(temp_filename, "wb") as file:
+                pickle.dump((self._template_count, self._bot_name, self._root), file, protocol)
+            os.replace(temp_filename, filename)
+            self._modified = False
         except:
             print("Error saving PatternManager to file %s:" % filename)
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
             raise
 
     def restore(self, filename: str) -> None:
         """Restore a previously saved collection of patterns."""
         try:
+            # Read the whole file with a single call and deserialize from
+            # memory, instead of having the loader pull it in piecemeal.
             with open(filename, "rb") as file:
-                self._template_count = marshal.load(file)
-                self._bot_name = marshal.load(file)
-                self._root = marshal.load(file)
+                data = file.read()
+            # Loading a brain allocates a great many dicts and lists, none of
+            # them garbage, which would otherwise set off the cyclic garbage
+            # collector over and over again.
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                # Pickle protocols 2 and up begin with the PROTO opcode.
+                # Anything else is a brain saved in the older marshal format.
+                if data[:1] == pickle.PROTO:
+                    self._template_count, self._bot_name, self._root = pickle.loads(data)
+                else:
+                    buffer = io.BytesIO(data)
+                    self._template_count = marshal.load(buffer)
+                    self._bot_name = marshal.load(buffer)
+                    self._root = marshal.load(buffer)
+                compiled_root = self._compile(self._root)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+            self._compiled_root = compiled_root
+            self._modified = False
         except:
             print("Error restoring PatternManager from file %s:" % filename)
             raise
@@ -82,59 +145,79 @@ class PatternManager:
         Add a [pattern/that/topic] tuple and its corresponding template
         to the node tree.
         """
+        self.add_many([((pattern, that, topic), template)])
+
+    def add_many(self, categories) -> None:
+        """
+        Add a collection of categories to the node tree. Each category is
+        a ((pattern, that, topic), template) pair, as found in the items
+        of an AimlHandler's categories dictionary.
+        """
 
         # TODO: make sure words contains only legal characters
         # (alphanumerics,*,_)
 
-        # Navigate through the node tree to the template's location, adding
-        # nodes if necessary.
-        node = self._root
-        for word in pattern.split():
-            key = word
-            if key == "_":
-                key = self._UNDERSCORE
-            elif key == "*":
-                key = self._STAR
-            elif key == "BOT_NAME":
-                key = self._BOT_NAME
-            if key not in node:
-                node[key] = {}
-            node = node[key]
-
-        # navigate further down, if a non-empty "that" pattern was included
-        if len(that) > 0:
-            if self._THAT not in node:
-                node[self._THAT] = {}
-            node = node[self._THAT]
-            for word in that.split():
-                key = word
-                if key == "_":
-                    key = self._UNDERSCORE
-                elif key == "*":
-                    key = self._STAR
-                if key not in node:
-                    node[key] = {}
-                node = node[key]
-
-        # navigate yet further down, if a non-empty "topic" string was included
-        if len(topic) > 0:
-            if self._TOPIC not in node:
-                node[self._TOPIC] = {}
-            node = node[self._TOPIC]
-            for word in topic.split():
-                key = word
-                if key == "_":
-                    key = self._UNDERSCORE
-                elif key == "*":
-                    key = self._STAR
-                if key not in node:
-                    node[key] = {}
-                node = node[key]
-
-        # add the template.
-        if self._TEMPLATE not in node:
-            self._template_count += 1
-        node[self._TEMPLATE] = template
+        # Bind everything the loop needs to locals up front.
+        root = self._root
+        template_key = _TEMPLATE
+        that_key = _THAT
+        topic_key = _TOPIC
+        pattern_keys = {"_": _UNDERSCORE, "*": _STAR, "BOT_NAME": _BOT_NAME}
+        context_keys = {"_": _UNDERSCORE, "*": _STAR}
+        # The same words appear in thousands of patterns, so they're interned
+        # to share one copy of each (which pickling the brain preserves).
+        intern = sys.intern
+        added = 0
+        # The ids of the existing nodes on the paths to the new templates.
+        # Only those nodes need compiling again, along with the new nodes,
+        # which have no compiled form yet.
+        changed = {id(root)}
+        mark_changed = changed.add
+
+        for (pattern, that, topic), template in categories:
+            # Navigate through the node tree to the template's location,
+            # adding nodes if necessary.
+            node = root
+            for word in map(intern, pattern.split()):
+                key = pattern_keys.get(word, word)
+                child = node.get(key)
+                if child is None:
+                    child = node[key] = {}
+                else:
+                    mark_changed(id(child))
+                node = child
+
+            # navigate further down, if a non-empty "that" pattern was
+            # included, and yet further down, if a non-empty "topic" string
+            # was included
+            for context, context_key in ((that, that_key), (topic, topic_key)):
+                if not context:
+                    continue
+                child = node.get(context_key)
+                if child is None:
+                    child = node[context_key] = {}
+                else:
+                    mark_changed(id(child))
+                node = child
+                for word in map(intern, context.split()):
+                    key = context_keys.get(word, word)
+                    child = node.get(key)
+                    if child is None:
+                        child = node[key] = {}
+                    else:
+                        mark_changed(id(child))
+                    node = child
+
+            # add the template.
+            if template_key not in node:
+                added += 1
+            node[template_key] = template
+            self._modified = True
+
+        self._template_count += added
+        # Matching only ever reads the compiled tree, which is swapped in
+        # whole, so it never sees the node tree while it's being changed.
+        self._compiled_root = self._compile(root, self._compiled_root, changed)
 
     def match(self, pattern, that, topic):
         """Return the template which is the closest match to pattern. The
@@ -145,23 +228,34 @@ class PatternManager:
         """
         if not pattern:
             return None
-        # Mutilate the input.  Remove all punctuation and convert the text to all caps.
-        text_input = pattern.upper()
-        text_input = re.sub(self._punctuation_re, " ", text_input)
         if that.strip() == "":
             that = "ULTRABOGUSDUMMYTHAT"  # 'that' must never be empty
-        thatInput = that.upper()
-        thatInput = re.sub(self._punctuation_re, " ", thatInput)
-        thatInput = re.sub(self._whitespace_re, " ", thatInput)
         if topic.strip() == "":
             topic = "ULTRABOGUSDUMMYTOPIC"  # 'topic' must never be empty
-        topicInput = topic.upper()
-        topicInput = re.sub(self._punctuation_re, " ", topicInput)
+        normalize = self._normalize
 
         # Pass the input off to the recursive call
-        patMatch, template = self._match(text_input.split(), thatInput.split(), topicInput.split(), self._root)
+        patMatch, template = self._match(normalize(pattern), 0, normalize(that), 0, normalize(topic), 0,
+                                         self._compiled_root, set())
         return template
 
+    def _normalize(self, text):
+        """Mutilate the input: remove all punctuation, convert the text to
+        all caps, and return a tuple of its words.
+
+        match() and star() normalize the same few inputs over and over, so
+        recent results are memoized. The memo is simply emptied when it
+        fills up. The words are interned, like the words of the compiled
+        node tree, so looking them up there mostly comes down to comparing
+        pointers.
+        """
+        words = self._normalized.get(text)
+        if words is None:
+            if len(self._normalized) >= self._max_normalized_size:
+                self._normalized.clear()
+            words = self._normalized[text] = tuple(map(sys.intern, text.upper().translate(self._punctuation_table).split()))
+        return words
+
     def star(self, starType, pattern, that, topic, index):
         """Returns a string, the portion of pattern that was matched by a *.
 
@@ -172,176 +266,204 @@ class PatternManager:
          - 'topicstar': matches a star in the topic pattern.
 
         """
-        # Mutilate the input.  Remove all punctuation and convert the
-        # text to all caps.
-        text_input = pattern.upper()
-        text_input = re.sub(self._punctuation_re, " ", text_input)
-        text_input = re.sub(self._whitespace_re, " ", text_input)
-        if that.strip() == "":
-            that = "ULTRABOGUSDUMMYTHAT"  # 'that' must never be empty
-        thatInput = that.upper()
-        thatInput = re.sub(self._punctuation_re, " ", thatInput)
-        thatInput = re.sub(self._whitespace_re, " ", thatInput)
-        if topic.strip() == "":
-            topic = "ULTRABOGUSDUMMYTOPIC"  # 'topic' must never be empty
-        topicInput = topic.upper()
-        topicInput = re.sub(self._punctuation_re, " ", topicInput)
-        topicInput = re.sub(self._whitespace_re, " ", topicInput)
-
-        # Pass the input off to the recursive pattern-matcher
-        patMatch, template = self._match(text_input.split(), thatInput.split(), topicInput.split(), self._root)
-        if template is None:
+        patMatch, originals = self._match_for_stars(pattern, that, topic)
+        if patMatch is None:
             return ""
 
         # Extract the appropriate portion of the pattern, based on the
         # starType argument.
+        keys = [key for key, position in patMatch]
         if starType == 'star':
-            patMatch = patMatch[:patMatch.index(self._THAT)]
-            words = text_input.split()
+            patMatch = patMatch[:keys.index(_THAT)]
+            original = originals[0]
         elif starType == 'thatstar':
-            patMatch = patMatch[patMatch.index(self._THAT)+1:patMatch.index(self._TOPIC)]
-            words = thatInput.split()
+            patMatch = patMatch[keys.index(_THAT)+1:keys.index(_TOPIC)]
+            original = originals[1]
         elif starType == 'topicstar':
-            patMatch = patMatch[patMatch.index(self._TOPIC)+1:]
-            words = topicInput.split()
+            patMatch = patMatch[keys.index(_TOPIC)+1:]
+            original = originals[2]
         else:
             # unknown value
             raise ValueError("starType must be in ['star', 'thatstar', 'topicstar']")
 
-        # compare the input string to the matched pattern, word by word.
-        # At the end of this loop, if foundTheRightStar is true, start and
-        # end will contain the start and end indices (in "words") of
-        # the substring that the desired star matched.
-        foundTheRightStar = False
-        start = end = j = numStars = k = 0
-        for i in range(len(words)):
-            # This condition is true after processing a star
-            # that ISN'T the one we're looking for.
-            if i < k:
-                continue
-            # If we're reached the end of the pattern, we're done.
-            if j == len(patMatch):
-                break
-            if not foundTheRightStar:
-                if patMatch[j] in [self._STAR, self._UNDERSCORE]:  # we got a star
-                    numStars += 1
-                    if numStars == index:
-                        # This is the star we care about.
-                        foundTheRightStar = True
-                    start = i
-                    # Iterate through the rest of the string.
-                    for k in range(i, len(words)):
-                        # If the star is at the end of the pattern,
-                        # we know exactly where it ends.
-                        if j + 1 == len(patMatch):
-                            end = len(words)
-                            break
-                        # If the words have started matching the
-                        # pattern again, the star has ended.
-                        if patMatch[j+1] == words[k]:
-                            end = k - 1
-                            # i = k
-                            break
-                # If we just finished processing the star we cared
-                # about, we exit the loop early.
-                if foundTheRightStar:
-                    break
-            # Move to the next element of the pattern.
-            j += 1
-
-        # extract the star words from the original, unmutilated input.
-        if foundTheRightStar:
-            #print string.join(pattern.split()[start:end+1])
-            if starType == 'star':
-                return ' '.join(pattern.split()[start:end+1])
-            elif starType == 'thatstar':
-                return ' '.join(that.split()[start:end+1])
-            elif starType == 'topicstar':
-                return ' '.join(topic.split()[start:end+1])
-        else:
+        # The matcher recorded where each element of the pattern starts in
+        # the words, so the star we want runs from its own position to the
+        # position of the next element (or to the end of the words).
+        stars = [i for i, (key, position) in enumerate(patMatch) if key == _STAR or key == _UNDERSCORE]
+        if not 0 < index <= len(stars):
             return ""
+        i = stars[index - 1]
+        start = patMatch[i][1]
+
+        # extract the star words from the original, unmutilated input. A
+        # star at the end of the pattern takes whatever is left of it.
+        if i + 1 == len(patMatch):
+            return ' '.join(original[start:])
+        return ' '.join(original[start:patMatch[i + 1][1]])
+
+    def _match_for_stars(self, pattern, that, topic):
+        """Return the path of the match for the input (in order from the
+        root, or None if nothing matched), and the words of the original
+        pattern, that and topic.
+
+        A template often contains several <star> elements, each of which
+        asks for the same input to be matched, so the last result is kept
+        and reused until the input, the bot's name or the node tree changes.
+        """
+        root = self._compiled_root
+        inputs = (pattern, that, topic, self._bot_name)
+        last = self._last_star_match
+        if last is not None and last[0] is root and last[1] == inputs:
+            return last[2], last[3]
 
-    def _match(self, words, thatWords, topicWords, root):
-        """Return a tuple (pat, tem) where pat is a list of nodes, starting
-        at the root and leading to the matching pattern, and tem is the
-        matched template.
+        if that.strip() == "":
+            that = "ULTRABOGUSDUMMYTHAT"  # 'that' must never be empty
+        if topic.strip() == "":
+            topic = "ULTRABOGUSDUMMYTOPIC"  # 'topic' must never be empty
+        normalize = self._normalize
 
+        # Pass the input off to the recursive pattern-matcher
+        patMatch, template = self._match(normalize(pattern), 0, normalize(that), 0, normalize(topic), 0, root, set())
+        if template is None:
+            patMatch = None
+        else:
+            patMatch.reverse()
+        originals = (pattern.split(), that.split(), topic.split())
+        self._last_star_match = (root, inputs, patMatch, originals)
+        return patMatch, originals
+
+    def _compile(self, node, compiled=None, changed=None):
+        """Return the compiled form of a node: a tuple with a slot for each
+        special key, holding the compiled child node (or the template, in
+        the _TEMPLATE slot), and a final _WORDS slot holding a dictionary of
+        the compiled children keyed by word. Missing children are None.
+
+        The matcher visits a node's special children on every step, and
+        indexing a tuple for them is cheaper than probing the dictionary.
+        The dictionary form is still the one patterns are added to, and the
+        one that gets saved. Its words are interned here, since a restored
+        brain's words are not.
+
+        If the node's previous compiled form is given, along with the set of
+        ids of the nodes changed since, only the changed nodes are compiled
+        again; the rest of the previous compiled tree is reused. Compiled
+        nodes are never modified, so a search running on the previous tree
+        isn't disturbed.
+        """
+        if compiled is not None and id(node) not in changed:
+            return compiled
+        if compiled is None:
+            compiled = (None,) * (_WORDS + 1)
+        old_words = compiled[_WORDS] or {}
+        slots = [None] * (_WORDS + 1)
+        words = slots[_WORDS] = {}
+        compile_node = self._compile
+        for key, child in node.items():
+            if key == _TEMPLATE:
+                slots[key] = child
+            elif isinstance(key, str):
+                key = sys.intern(key)
+                old_child = old_words.get(key)
+                # Most children are unchanged, so they're checked here
+                # rather than by a recursive call.
+                if old_child is None or id(child) in changed:
+                    old_child = compile_node(child, old_child, changed)
+                words[key] = old_child
+            else:
+                slots[key] = compile_node(child, compiled[key], changed)
+        return tuple(slots)
+
+    def _match(self, words, wi, thatWords, twi, topicWords, toi, root, failed):
+        """Return a tuple (pat, tem) where pat is a list of (node, position)
+        pairs leading from the matching pattern back to the root, and tem is
+        the matched template. Each position is the index of the word where
+        that node's part of the match begins. The list is built in reverse
+        so each level of the search can append to it instead of copying it.
+
+        Only the words from the indices wi, twi and toi onward remain to be
+        matched; the word lists themselves are never copied. The root is a
+        compiled node (see _compile).
+
+        The failed set holds the (node id, wi, twi, toi) states already
+        known not to match, so backtracking over several wildcards never
+        searches the same state twice. It must only be shared within a
+        single top-level search.
         """
         # base-case: if the word list is empty, return the current node's
         # template.
-        if len(words) == 0:
+        if wi == len(words):
             # we're out of words.
             pattern = []
             template = None
-            if len(thatWords) > 0:
+            if twi < len(thatWords):
                 # If thatWords isn't empty, recursively
                 # pattern-match on the _THAT node with thatWords as words.
-                try:
-                    pattern, template = self._match(thatWords, [], topicWords, root[self._THAT])
+                node = root[_THAT]
+                if node is not None:
+                    pattern, template = self._match(thatWords, twi, (), 0, topicWords, toi, node, failed)
                     if pattern is not None:
-                        pattern = [self._THAT] + pattern
-                except KeyError:
-                    pattern = []
-                    template = None
-            elif len(topicWords) > 0:
+                        pattern.append((_THAT, wi))
+            elif toi < len(topicWords):
                 # If thatWords is empty and topicWords isn't, recursively pattern
                 # on the _TOPIC node with topicWords as words.
-                try:
-                    pattern, template = self._match(topicWords, [], [], root[self._TOPIC])
+                node = root[_TOPIC]
+                if node is not None:
+                    pattern, template = self._match(topicWords, toi, (), 0, (), 0, node, failed)
                     if pattern is not None:
-                        pattern = [self._TOPIC] + pattern
-                except KeyError:
-                    pattern = []
-                    template = None
+                        pattern.append((_TOPIC, wi))
             if template is None:
                 # we're totally out of input.  Grab the template at this node.
                 pattern = []
-                try:
-                    template = root[self._TEMPLATE]
-                except KeyError:
-                    template = None
+                template = root[_TEMPLATE]
             return pattern, template
 
-        first = words[0]
-        suffix = words[1:]
+        state = (id(root), wi, twi, toi)
+        if state in failed:
+            return None, None
+
+        first = words[wi]
+        end = len(words)
 
         # Check underscore.
         # Note: this is causing problems in the standard AIML set, and is
         # currently disabled.
-        if self._UNDERSCORE in root:
-            # Must include the case where suf is [] in order to handle the case
+        node = root[_UNDERSCORE]
+        if node is not None:
+            # Must include the case where no words are left in order to handle the case
             # where a * or _ is at the end of the pattern.
-            for j in range(len(suffix)+1):
-                suf = suffix[j:]
-                pattern, template = self._match(suf, thatWords, topicWords, root[self._UNDERSCORE])
+            for j in range(wi + 1, end + 1):
+                pattern, template = self._match(words, j, thatWords, twi, topicWords, toi, node, failed)
                 if template is not None:
-                    newPattern = [self._UNDERSCORE] + pattern
-                    return newPattern, template
+                    pattern.append((_UNDERSCORE, wi))
+                    return pattern, template
 
         # Check first
-        if first in root:
-            pattern, template = self._match(suffix, thatWords, topicWords, root[first])
+        node = root[_WORDS].get(first)
+        if node is not None:
+            pattern, template = self._match(words, wi + 1, thatWords, twi, topicWords, toi, node, failed)
             if template is not None:
-                newPattern = [first] + pattern
-                return newPattern, template
+                pattern.append((first, wi))
+                return pattern, template
 
         # check bot name
-        if self._BOT_NAME in root and first == self._bot_name:
-            pattern, template = self._match(suffix, thatWords, topicWords, root[self._BOT_NAME])
+        node = root[_BOT_NAME]
+        if node is not None and first == self._bot_name:
+            pattern, template = self._match(words, wi + 1, thatWords, twi, topicWords, toi, node, failed)
             if template is not None:
-                newPattern = [first] + pattern
-                return newPattern, template
+                pattern.append((first, wi))
+                return pattern, template
 
         # check star
-        if self._STAR in root:
-            # Must include the case where suf is [] in order to handle the case
+        node = root[_STAR]
+        if node is not None:
+            # Must include the case where no words are left in order to handle the case
             # where a * or _ is at the end of the pattern.
-            for j in range(len(suffix)+1):
-                suf = suffix[j:]
-                pattern, template = self._match(suf, thatWords, topicWords, root[self._STAR])
+            for j in range(wi + 1, end + 1):
+                pattern, template = self._match(words, j, thatWords, twi, topicWords, toi, node, failed)
                 if template is not None:
-                    newPattern = [self._STAR] + pattern
-                    return newPattern, template
+                    pattern.append((_STAR, wi))
+                    return pattern, template
 
         # No matches were found.
+        failed.add(state)
         return None, None
@@ -0,0 +1,30 @@
+"""
+This module implements the Session class, which holds the state of a
+single conversation with the bot.
+"""
+
+import collections
+import threading
+
+
+class Session:
+    """The state of a single conversation: its predicates, the input and
+    output histories, and the input stack."""
+
+    __slots__ = ['lock', 'predicates', 'input_history', 'output_history', 'input_stack', 'subbed_input',
+                 'subbed_that', 'subbed_topic']
+
+    def __init__(self, max_history_size: int = None):
+        self.lock = threading.Lock()  # held while the bot responds to this session
+        self.predicates = {}
+        # The histories drop their oldest entries once they are full.
+        self.input_history = collections.deque(maxlen=max_history_size)  # recent user input
+        self.output_history = collections.deque(maxlen=max_history_size)  # recent responses
+        self.input_stack = []  # should always be empty in between calls to respond()
+
+        # The most recent input, 'that' and topic, paired with their forms
+        # after the 'normal' substitutions, so they only need to be
+        # substituted again when they change.
+        self.subbed_input = ('', '')
+        self.subbed_that = ('', '')
+        self.subbed_topic = ('', '')
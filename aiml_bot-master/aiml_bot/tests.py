@@ -1,8 +1,10 @@
 import os
 import sys
+import tempfile
 import time
 
 from .bot import Bot, BOOTSTRAP_AIML_PATH
+from .pattern_manager import PatternManager
 from .utilities import split_sentences
 from .word_substitutions import WordSub
 
@@ -15,6 +17,28 @@ def test_split_sentences():
     results = split_sentences("First.  Second, still?  Third and Final!  Well, not really")
     assert results == ['First.', 'Second, still?', 'Third and Final!', 'Well, not really'], results
 
+    # runs of terminators stay with their sentence
+    results = split_sentences("Really?!  Wait... what")
+    assert results == ['Really?!', 'Wait...', 'what'], results
+
+
+def test_star():
+    patterns = PatternManager()
+    for pattern in ["* B", "* YOU", "* * END", "HELLO *"]:
+        patterns.add(pattern, "*", "*", ['template', {}, pattern])
+
+    # the star's first word is the same as the literal after it
+    assert patterns.star('star', "b b", "", "", 1) == "b"
+    # the literal after the star also appears earlier in the input
+    assert patterns.star('star', "a you c you", "", "", 1) == "a you c"
+    # adjacent stars
+    assert patterns.star('star', "x y z end", "", "", 1) == "x"
+    assert patterns.star('star', "x y z end", "", "", 2) == "y z"
+    # a star at the end of the pattern takes the rest of the input
+    assert patterns.star('star', "hello big world", "", "", 1) == "big world"
+    # there's no such star
+    assert patterns.star('star', "hello big world", "", "", 2) == ""
+
 
 def test_word_sub():
     subber = WordSub()
@@ -27,20 +51,321 @@ def test_word_sub():
     # test case insensitivity
     text = "I'd like one apple, one Orange and one BANANA."
     result = "I would like one banana, one Pear and one APPLE."
-    if subber.sub(text) == result:
-        print("Test #1 PASSED")
-    else:
-        print("Test #1 FAILED: '%s'" % subber.sub(text))
+    assert subber.sub(text) == result, "Test #1 FAILED: '%s'" % subber.sub(text)
 
     text = "He said he'd like to go with me"
     result = "She said she'd like to go with me"
-    if subber.sub(text) == result:
-        print("Test #2 PASSED")
+    assert subber.sub(text) == result, "Test #2 FAILED: '%s'" % subber.sub(text)
+
+    # words in mixed case are replaced in lowercase
+    text = "one aPPle and one oRANGE"
+    result = "one banana and one pear"
+    assert subber.sub(text) == result, "Test #3 FAILED: '%s'" % subber.sub(text)
+
+    # several texts can be translated at once
+    texts = ["one apple", "he", "", "an orange"]
+    results = ["one banana", "she", "", "an pear"]
+    assert subber.sub_many(texts) == results, "Test #4 FAILED: '%s'" % subber.sub_many(texts)
+
+    # texts containing the separator sub_many() joins them with are
+    # translated one by one
+    texts = ["one apple\x1fhe", "an orange"]
+    results = ["one banana\x1fshe", "an pear"]
+    assert subber.sub_many(texts) == results, "Test #5 FAILED: '%s'" % subber.sub_many(texts)
+
+
+def test_bot_name():
+    k = Bot(learn=[BOOTSTRAP_AIML_PATH, SELF_TEST_AIML_PATH], verbose=False)
+    assert k.respond("test bot") == "My name is Nameless"
+
+    # Renaming the bot discards the responses given under the old name.
+    k.name = "Robby"
+    assert k.name == "Robby"
+    assert k.respond("test bot") == "My name is Robby"
+
+
+def test_bot_name_while_responding():
+    k = Bot(learn=[BOOTSTRAP_AIML_PATH, SELF_TEST_AIML_PATH], verbose=False)
+    process_element = k._process_element
+
+    # The bot is renamed while the response is rendered with the old name,
+    # as if by another thread. That response mustn't be kept afterward.
+    def process_and_rename(element, session_id):
+        response = process_element(element, session_id)
+        if element[0] == 'template' and k.name != "Robby":
+            k.name = "Robby"
+        return response
+    k._process_element = process_and_rename
+    assert k.respond("test bot") == "My name is Nameless"
+    assert k.respond("test bot") == "My name is Robby"
+
+
+def test_bot_name_star():
+    patterns = PatternManager()
+    patterns.add("HI BOT_NAME *", "*", "*", ['template', {}, 'name'])
+    patterns.add("HI *", "*", "*", ['template', {}, 'star'])
+
+    patterns.bot_name = "ALICE"
+    assert patterns.match("hi alice there", "", "") == ['template', {}, 'name']
+    assert patterns.star('star', "hi alice there", "", "", 1) == "there"
+
+    # Renaming the bot changes which pattern matches, and so the stars.
+    patterns.bot_name = "BOB"
+    assert patterns.match("hi alice there", "", "") == ['template', {}, 'star']
+    assert patterns.star('star', "hi alice there", "", "", 1) == "alice there"
+
+
+def test_response_cache(tmp_path):
+    k = Bot(learn=[BOOTSTRAP_AIML_PATH, SELF_TEST_AIML_PATH], verbose=False)
+    matched = []
+    match = k._brain.match
+    k._brain.match = lambda *args: matched.append(args) or match(*args)
+
+    # A response without side effects is memoized, and the input isn't
+    # matched again. The bot's previous response is part of the key, so the
+    # memo is only used the third time.
+    for _ in range(3):
+        assert k.respond("test formal") == "Formal Test Passed"
+    assert len(matched) == 2
+
+    # Learning new categories discards the memoized responses.
+    aiml_path = tmp_path / 'override.aiml'
+    aiml_path.write_text('<aiml version="1.0"><category><pattern>TEST FORMAL</pattern>'
+                         '<template>Overridden</template></category></aiml>')
+    k.learn(str(aiml_path))
+    assert k.respond("test formal") == "Overridden"
+
+    # A response computed while the memoized responses are being discarded
+    # isn't memoized, since it may already be out of date.
+    def match_and_clear(*args):
+        k._clear_caches()
+        return match(*args)
+    k._brain.match = match_and_clear
+    assert k.respond("test formal") == "Overridden"
+    assert not k._response_cache
+
+
+def test_handler_override():
+    class CustomBot(Bot):
+        def _process_version(self, element: list, session_id: str) -> str:
+            return "custom version"
+
+    k = CustomBot(learn=[BOOTSTRAP_AIML_PATH, SELF_TEST_AIML_PATH], verbose=False)
+    assert k.respond("test version") == "AIML Bot is version custom version"
+
+
+def test_category_cache(tmp_path):
+    aiml_path = tmp_path / 'test.aiml'
+    cache_dir = tmp_path / 'cache'
+    category = '<aiml version="1.0"><category><pattern>HELLO</pattern><template>%s</template></category></aiml>'
+
+    aiml_path.write_text(category % 'Hi')
+    k = Bot(learn=[str(aiml_path)], verbose=False, cache_dir=str(cache_dir))
+    assert k.respond("hello") == "Hi"
+    assert len(os.listdir(str(cache_dir))) == 1
+
+    # A changed file is parsed again, and its cache entry replaced.
+    aiml_path.write_text(category % 'Hello there')
+    os.utime(str(aiml_path), ns=(0, 0))
+    k = Bot(learn=[str(aiml_path)], verbose=False, cache_dir=str(cache_dir))
+    assert k.respond("hello") == "Hello there"
+    assert len(os.listdir(str(cache_dir))) == 1
+
+    # An unreadable cache entry is ignored.
+    cache_path, = cache_dir.iterdir()
+    cache_path.write_bytes(b'\x80\x04not a pickle')
+    k = Bot(learn=[str(aiml_path)], verbose=False, cache_dir=str(cache_dir))
+    assert k.respond("hello") == "Hello there"
+
+
+def test_word_sub_case():
+    subber = WordSub({"apple": "banana", "i'd": "I would"})
+    # The replacement follows the case of the word it replaces: all caps,
+    # capitalized, or anything else, which is replaced in lowercase. The
+    # case of the key and value given doesn't matter.
+    assert subber.sub("APPLE") == "BANANA"
+    assert subber.sub("Apple") == "Banana"
+    assert subber.sub("ApPLE") == "Banana"
+    assert subber.sub("apple") == "banana"
+    assert subber.sub("aPPLE") == "banana"
+    assert subber.sub("I'D") == "I WOULD"
+    assert subber.sub("i'd") == "i would"
+    assert subber["APPLE"] == "banana"
+    assert "Apple" in subber
+
+
+def test_condition_invalid_list_item():
+    # The parser rejects these <condition> elements, but templates can also
+    # come from elsewhere, e.g. a brain file.
+    def li(attributes, text):
+        return ['li', attributes, ['text', {'xml:space': 'default'}, text]]
+    k = Bot(learn=[], verbose=False)
+    k._brain.add("MISSING VALUE", "*", "*", ['template', {}, ['condition', {'name': 'gender'},
+                 li({'value': 'male'}, "handsome"), li({'other': 'x'}, "no value"), li({}, "default")]])
+    k._brain.add("LAST ATTRIBUTE", "*", "*", ['template', {}, ['condition', {'name': 'gender'},
+                 li({'value': 'male'}, "handsome"), li({'other': 'x'}, "not a default")]])
+
+    # An <li> without the attributes it needs is only an error if none of
+    # the <li> elements before it match. A last <li> with attributes other
+    # than name and value isn't a default.
+    # An error leaves the session's input stack behind, so each input gets a
+    # session of its own.
+    for text in ["missing value", "last attribute"]:
+        k.set_predicate('gender', 'male', text)
+        assert k.respond(text, text) == "handsome"
+        k.set_predicate('gender', 'female', text)
+        try:
+            k.respond(text, text)
+        except KeyError:
+            pass
+        else:
+            assert False, "no error for %r" % text
+
+
+def test_learn_error(tmp_path):
+    for name in ['a', 'b']:
+        (tmp_path / (name + '.aiml')).write_text(
+            '<aiml version="1.0"><category><pattern>%s</pattern><template>%s</template></category></aiml>'
+            % (name.upper(), name))
+
+    class FailingBot(Bot):
+        """A bot which fails to load the second AIML file it learns."""
+        loaded = 0
+
+        def _load_cached_categories(self, cache_path, cache_stamp):
+            self.loaded += 1
+            if self.loaded == 2:
+                raise OSError("failed to load")
+            return None
+
+    # The file learned before the error is kept.
+    k = FailingBot(learn=[], verbose=False, cache_dir=str(tmp_path / 'cache'))
+    try:
+        k.learn(str(tmp_path / '*.aiml'))
+    except OSError:
+        pass
+    else:
+        assert False, "no error"
+    assert k.category_count == 1
+
+
+# The Bot self-tests, in order: (tag, input, acceptable responses). The
+# responses are formatted with the bot as k and the current time as date.
+# Entries of the form (None, name, value) set a predicate instead.
+BOT_TESTS = [
+    ('bot', 'test bot', ["My name is Nameless"]),
+    (None, 'gender', 'male'),
+    ('condition test #1', 'test condition name value', ['You are handsome']),
+    (None, 'gender', 'female'),
+    ('condition test #2', 'test condition name value', ['']),
+    ('condition test #3', 'test condition name', ['You are beautiful']),
+    (None, 'gender', 'robot'),
+    ('condition test #4', 'test condition name', ['You are genderless']),
+    ('condition test #5', 'test condition', ['You are genderless']),
+    (None, 'gender', 'male'),
+    ('condition test #6', 'test condition', ['You are handsome']),
+    ('date', 'test date', ["The date is {date}"]),
+    ('formal', 'test formal', ["Formal Test Passed"]),
+    ('gender', 'test gender', ["He'd told her he heard that her hernia is history"]),
+    ('get/set', 'test get and set', ["I like cheese. My favorite food is cheese"]),
+    ('gossip', 'test gossip', ["Gossip is not yet implemented"]),
+    ('id', 'test id', ["Your id is anonymous"]),
+    ('input', 'test input', ['You just said: test input']),
+    ('javascript', 'test javascript', ["Javascript is not yet implemented"]),
+    ('lowercase', 'test lowercase', ["The Last Word Should Be lowercase"]),
+    ('person', 'test person', ['HE think i knows that my actions threaten him and his.']),
+    ('person2', 'test person2', ['YOU think me know that my actions threaten you and yours.']),
+    ('person2 (no contents)', 'test person2 I Love Lucy', ['YOU Love Lucy']),
+    ('random', 'test random', ["response #1", "response #2", "response #3"]),
+    ('random empty', 'test random empty', ["Nothing here!"]),
+    ('sentence', "test sentence", ["My first letter should be capitalized."]),
+    ('size', "test size", ["I've learned {k.category_count} categories"]),
+    ('sr', "test sr test srai", ["srai results: srai test passed"]),
+    ('sr nested', "test nested sr test srai", ["srai results: srai test passed"]),
+    ('srai', "test srai", ["srai test passed"]),
+    ('srai infinite', "test srai infinite", [""]),
+    ('star test #1', 'intro scroll test star begin', ['Begin star matched: intro scroll']),
+    ('star test #2', 'test star creamy goodness middle', ['Middle star matched: creamy goodness']),
+    ('star test #3', 'test star end the credits roll', ['End star matched: the credits roll']),
+    ('star test #4', 'test star having multiple stars in a pattern makes me extremely happy',
+     ['Multiple stars matched: having, stars in a pattern, extremely happy']),
+    ('system', "test system", ["The system says hello!"]),
+    ('that test #1', "test that", ["I just said: The system says hello!"]),
+    ('that test #2', "test that", ["I have already answered this question"]),
+    ('thatstar test #1', "test thatstar", ["I say beans"]),
+    ('thatstar test #2', "test thatstar", ["I just said \"beans\""]),
+    ('thatstar test #3', "test thatstar multiple", ['I say beans and franks for everybody']),
+    ('thatstar test #4', "test thatstar multiple", ['Yes, beans and franks for all!']),
+    ('think', "test think", [""]),
+    (None, "topic", "fruit"),
+    ('topic', "test topic", ["We were discussing apples and oranges"]),
+    (None, "topic", "Soylent Green"),
+    ('topicstar test #1', 'test topicstar', ["Soylent Green is made of people!"]),
+    (None, "topic", "Soylent Ham and Cheese"),
+    ('topicstar test #2', 'test topicstar multiple', ["Both Soylents Ham and Cheese are made of people!"]),
+    ('unicode support', "ÔÇÉÏºÃ", ["Hey, you speak Chinese! ÔÇÉÏºÃ"]),
+    ('uppercase', 'test uppercase', ["The Last Word Should Be UPPERCASE"]),
+    ('version', 'test version', ["AIML Bot is version {k.version}"]),
+    ('whitespace preservation', 'test whitespace',
+     ["Extra   Spaces\n   Rule!   (but not in here!)    But   Here   They   Do!"]),
+]
+
+
+def _expected_responses(k: Bot, outputs: list) -> list:
+    """Fill in the acceptable responses of one of the BOT_TESTS."""
+    return [output.format(k=k, date=time.asctime()) for output in outputs]
+
+
+class BotTestRun:
+    """A bot running through the entries of BOT_TESTS in order. The
+    bot_test_run fixture shares one of these between the test_bot_tag
+    cases."""
+
+    def __init__(self):
+        self.bot = None
+        self.position = 0  # the index of the next entry of BOT_TESTS to run
+
+    def prepare(self, index: int) -> Bot:
+        """Return a bot which has run all the entries of BOT_TESTS before the
+        given index, and which will then run the entry at the index. The
+        same bot is reused as long as the tests run in order; otherwise, a
+        new one is started."""
+        if self.bot is None or self.position > index:
+            self.bot = Bot(learn=[BOOTSTRAP_AIML_PATH, SELF_TEST_AIML_PATH], commands="load std aiml",
+                           verbose=False)
+            self.position = 0
+        for tag, text, outputs in BOT_TESTS[self.position:index]:
+            if tag is None:
+                self.bot.set_predicate(text, outputs)
+            else:
+                self.bot.respond(text)
+        self.position = index + 1
+        return self.bot
+
+
+def pytest_generate_tests(metafunc):
+    """Run each of the BOT_TESTS as a test case of its own under pytest."""
+    if 'bot_test_index' in metafunc.fixturenames:
+        indexes = [index for index, (tag, text, outputs) in enumerate(BOT_TESTS) if tag is not None]
+        metafunc.parametrize('bot_test_index', indexes, ids=[BOT_TESTS[index][0] for index in indexes])
+
+
+def test_bot_tag(bot_test_run: BotTestRun, bot_test_index: int):
+    k = bot_test_run.prepare(bot_test_index)
+    tag, text, outputs = BOT_TESTS[bot_test_index]
+    response = k.respond(text)
+    if tag == 'date':
+        # The response can't be compared with the current time exactly,
+        # since a second can pass before it's checked.
+        prefix = "The date is "
+        assert response.startswith(prefix), response
+        date = time.mktime(time.strptime(response[len(prefix):]))
+        assert abs(time.time() - date) < 5, response
     else:
-        print("Test #2 FAILED: '%s'" % subber.sub(text))
+        assert response in _expected_responses(k, outputs), response
 
 
-def test_bot():
+def run_self_tests():
     """Run some self-tests on the Bot."""
     k = Bot(learn=[BOOTSTRAP_AIML_PATH, SELF_TEST_AIML_PATH], commands="load std aiml")
 
@@ -64,19 +389,6 @@ def test_bot():
             print("FAILED (response: '%s')" % response)
             return False
 
-    _testTag(k, 'bot', 'test bot', ["My name is Nameless"])
-
-    k.set_predicate('gender', 'male')
-    _testTag(k, 'condition test #1', 'test condition name value', ['You are handsome'])
-    k.set_predicate('gender', 'female')
-    _testTag(k, 'condition test #2', 'test condition name value', [''])
-    _testTag(k, 'condition test #3', 'test condition name', ['You are beautiful'])
-    k.set_predicate('gender', 'robot')
-    _testTag(k, 'condition test #4', 'test condition name', ['You are genderless'])
-    _testTag(k, 'condition test #5', 'test condition', ['You are genderless'])
-    k.set_predicate('gender', 'male')
-    _testTag(k, 'condition test #6', 'test condition', ['You are handsome'])
-
     # the date test will occasionally fail if the original and "test"
     # times cross a second boundary.  There's no good way to avoid
     # this problem and still do a meaningful test, so we simply
@@ -86,52 +398,13 @@ def test_bot():
     succeeds.  So long as the response looks like a date/time string,
     there's nothing to worry about.
     """
-    if not _testTag(k, 'date', 'test date', ["The date is %s" % time.asctime()]):
-        print(date_warning)
-
-    _testTag(k, 'formal', 'test formal', ["Formal Test Passed"])
-    _testTag(k, 'gender', 'test gender', ["He'd told her he heard that her hernia is history"])
-    _testTag(k, 'get/set', 'test get and set', ["I like cheese. My favorite food is cheese"])
-    _testTag(k, 'gossip', 'test gossip', ["Gossip is not yet implemented"])
-    _testTag(k, 'id', 'test id', ["Your id is anonymous"])
-    _testTag(k, 'input', 'test input', ['You just said: test input'])
-    _testTag(k, 'javascript', 'test javascript', ["Javascript is not yet implemented"])
-    _testTag(k, 'lowercase', 'test lowercase', ["The Last Word Should Be lowercase"])
-    _testTag(k, 'person', 'test person', ['HE think i knows that my actions threaten him and his.'])
-    _testTag(k, 'person2', 'test person2', ['YOU think me know that my actions threaten you and yours.'])
-    _testTag(k, 'person2 (no contents)', 'test person2 I Love Lucy', ['YOU Love Lucy'])
-    _testTag(k, 'random', 'test random', ["response #1", "response #2", "response #3"])
-    _testTag(k, 'random empty', 'test random empty', ["Nothing here!"])
-    _testTag(k, 'sentence', "test sentence", ["My first letter should be capitalized."])
-    _testTag(k, 'size', "test size", ["I've learned %d categories" % k.category_count])
-    _testTag(k, 'sr', "test sr test srai", ["srai results: srai test passed"])
-    _testTag(k, 'sr nested', "test nested sr test srai", ["srai results: srai test passed"])
-    _testTag(k, 'srai', "test srai", ["srai test passed"])
-    _testTag(k, 'srai infinite', "test srai infinite", [""])
-    _testTag(k, 'star test #1', 'intro scroll test star begin', ['Begin star matched: intro scroll'])
-    _testTag(k, 'star test #2', 'test star creamy goodness middle', ['Middle star matched: creamy goodness'])
-    _testTag(k, 'star test #3', 'test star end the credits roll', ['End star matched: the credits roll'])
-    _testTag(k, 'star test #4', 'test star having multiple stars in a pattern makes me extremely happy',
-             ['Multiple stars matched: having, stars in a pattern, extremely happy'])
-    _testTag(k, 'system', "test system", ["The system says hello!"])
-    _testTag(k, 'that test #1', "test that", ["I just said: The system says hello!"])
-    _testTag(k, 'that test #2', "test that", ["I have already answered this question"])
-    _testTag(k, 'thatstar test #1', "test thatstar", ["I say beans"])
-    _testTag(k, 'thatstar test #2', "test thatstar", ["I just said \"beans\""])
-    _testTag(k, 'thatstar test #3', "test thatstar multiple", ['I say beans and franks for everybody'])
-    _testTag(k, 'thatstar test #4', "test thatstar multiple", ['Yes, beans and franks for all!'])
-    _testTag(k, 'think', "test think", [""])
-    k.set_predicate("topic", "fruit")
-    _testTag(k, 'topic', "test topic", ["We were discussing apples and oranges"])
-    k.set_predicate("topic", "Soylent Green")
-    _testTag(k, 'topicstar test #1', 'test topicstar', ["Soylent Green is made of people!"])
-    k.set_predicate("topic", "Soylent Ham and Cheese")
-    _testTag(k, 'topicstar test #2', 'test topicstar multiple', ["Both Soylents Ham and Cheese are made of people!"])
-    _testTag(k, 'unicode support', "ÔÇÉÏºÃ", ["Hey, you speak Chinese! ÔÇÉÏºÃ"])
-    _testTag(k, 'uppercase', 'test uppercase', ["The Last Word Should Be UPPERCASE"])
-    _testTag(k, 'version', 'test version', ["AIML Bot is version %s" % k.version])
-    _testTag(k, 'whitespace preservation', 'test whitespace',
-             ["Extra   Spaces\n   Rule!   (but not in here!)    But   Here   They   Do!"])
+
+    for tag, text, outputs in BOT_TESTS:
+        if tag is None:
+            k.set_predicate(text, outputs)
+            continue
+        if not _testTag(k, tag, text, _expected_responses(k, outputs)) and tag == 'date':
+            print(date_warning)
 
     # Report test results
     print("--------------------")
@@ -145,11 +418,16 @@ def test_bot():
     # while True: print k.respond(raw_input("> "))
 
 
-def stress_test(output_file: str = None):
+def stress_test(output_file: str = None, max_responses: int = None, max_chars: int = None):
     """
     This is the AIML Bot stress test. It creates two bots, and connects them in
     a cyclic loop.  A lot of output is generated; piping the results to a file
     is highly recommended.
+
+    The test runs until it's interrupted, unless max_responses or max_chars
+    is given, in which case it stops once the bots have responded that many
+    times, or written that many characters of responses. Either way, the
+    number of responses per second is reported at the end.
     """
 
     if output_file is None:
@@ -165,24 +443,45 @@ def stress_test(output_file: str = None):
         # Create the bots
         print("Initializing Bot #1", file=output_file)
         bot1 = Bot(commands='load std aiml', verbose=False)
-        bot1.save_brain("stress.brn")
         print("\nInitializing Bot #2", file=output_file)
-        bot2 = Bot(brain_file="stress.brn", verbose=False)
-        os.remove("stress.brn")
+        # The second bot loads the first bot's brain, saved to a temporary
+        # directory rather than the working directory.
+        with tempfile.TemporaryDirectory() as temp_dir:
+            brain_path = os.path.join(temp_dir, 'stress.brn')
+            bot1.save_brain(brain_path)
+            bot2 = Bot(brain_file=brain_path, verbose=False)
+        bots = (bot1, bot2)
 
         # Start the bots off with some basic input.
         response = "askquestion"
 
-        # Off they go!
-        while True:
-            response = bot1.respond(response).strip()
-            print("1:", response, file=output_file)
-            response = bot2.respond(response).strip()
-            print("2:", response, file=output_file)
-            # If the robots have run out of things to say, force one of them
-            # to break the ice.
-            if response == "":
-                response = "askquestion"
+        # Off they go! The exchanges are written out a hundred at a time, so
+        # a line-buffered terminal isn't written to for every line.
+        lines = []
+        responses = 0
+        written = 0
+        start = time.perf_counter()
+        try:
+            while ((max_responses is None or responses < max_responses) and
+                   (max_chars is None or written < max_chars)):
+                which = responses % 2
+                response = bots[which].respond(response).strip()
+                line = "%d: %s\n" % (which + 1, response)
+                lines.append(line)
+                responses += 1
+                written += len(line)
+                if len(lines) >= 200:
+                    output_file.write(''.join(lines))
+                    lines.clear()
+                # If the robots have run out of things to say, force one of them
+                # to break the ice.
+                if which == 1 and response == "":
+                    response = "askquestion"
+        finally:
+            output_file.write(''.join(lines))
+            elapsed = time.perf_counter() - start
+            print("\n%d responses in %.2f seconds (%.1f responses/second)" %
+                  (responses, elapsed, responses / elapsed if elapsed else 0.0), file=output_file)
     finally:
         if close_output:
             output_file.close()
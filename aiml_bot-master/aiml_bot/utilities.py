@@ -3,36 +3,25 @@ This file contains assorted general utility functions used by other
 modules in the aiml_bot package.
 """
 
+import re
+
+
+# A sentence starts with anything but whitespace or a terminator, and runs
+# through the terminators that end it.
+_SENTENCE_RE = re.compile(r'[^.!?\s][^.!?]*[.!?]*')
+
 
 # TODO: Correctly handle abbreviations.
 def split_sentences(text: str) -> list:
     """Split the string s into a list of sentences."""
     if not isinstance(text, str):
         raise TypeError(text)
-    position = 0
-    results = []
-    length = len(text)
-    while position < length:
-        try:
-            period = text.index('.', position)
-        except ValueError:
-            period = length + 1
-        try:
-            question = text.index('?', position)
-        except ValueError:
-            question = length + 1
-        try:
-            exclamation = text.index('!', position)
-        except ValueError:
-            exclamation = length + 1
-        end = min(period, question, exclamation)
-        sentence = text[position:end].strip()
-        if sentence:
-            results.append(sentence)
-        position = end + 1
+    # Most input is a single sentence with no terminator at all.
+    if '.' not in text and '?' not in text and '!' not in text:
+        return [text.strip()]
+    results = [sentence.rstrip() for sentence in _SENTENCE_RE.findall(text)]
     # If no sentences were found, return a one-item list containing
     # the entire input string.
     if not results:
         results.append(text.strip())
-    # print(results)
     return results
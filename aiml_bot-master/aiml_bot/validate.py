@@ -26,19 +26,23 @@ def main():
     # AimlParser prints its errors to stderr; we redirect stderr to stdout.
     sys.stderr = sys.stdout
 
+    # One parser and handler are reused for all the files.
+    parser = aiml_parser.create_parser()
+    handler = parser.getContentHandler()  # type: aiml_parser.AimlHandler
+
     # Iterate over input files    
     valid_count = 0
     doc_count = 0
     for arg in sys.argv[1:]:
         # Input files can contain wildcards; iterate over matches
         for f in glob.glob(arg):
-            parser = xml.sax.make_parser(["aiml.aiml_parser"])
-            handler = parser.getContentHandler()  # type: aiml_parser.AimlHandler
+            handler.reset()
             doc_count += 1
             print("%s:" % f)
             try:
                 # Attempt to parse the file.
-                parser.parse(f)
+                with open(f, 'rb') as file:
+                    parser.parse(file)
                 # Check the number of parse errors.
                 if handler.getNumErrors() == 0:
                     valid_count += 1
@@ -21,57 +21,224 @@ The following example illustrates this point:
     she says she'd like to help her
 Note that "he" and "he'd" were replaced, but "help" and "her" were
 not.
-"""
 
-# 'dict' objects weren't available to subclass from until version 2.2.
-# Get around this by importing UserDict.UserDict if the built-in dict
-# object isn't available.
+If the pyahocorasick package is installed, the substitutions are found
+with an Aho-Corasick automaton, which scans the text once no matter how
+many words there are. Otherwise, a single regular expression matching
+any of the words is used.
+"""
 
 import re
+import sys
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 
+def _is_word_boundary(text, index):
+    """Return whether a regex \\b would match at the given index of the text."""
+    before = index > 0 and (text[index - 1].isalnum() or text[index - 1] == '_')
+    after = index < len(text) and (text[index].isalnum() or text[index] == '_')
+    return before != after
 
-class WordSub(dict):
+
+class WordSub:
     """All-in-one multiple-string-substitution class."""
 
+    __slots__ = ['_map', '_cache', '_regex_parts', '_regex', '_automaton', '_regexIsDirty']
+
+    _max_cache_size = 1024  # maximum number of memoized translations
+    _separator = '\x1f'  # joins the texts translated together by sub_many()
+    _max_prefiltered_size = 8  # maximum number of keys to look for one by one
+
     @staticmethod
     def _wordToRegex(word):
         """Convert a word to a regex object which matches the word."""
         return r"\b%s\b" % re.escape(word)
     
+    @staticmethod
+    def _match_case(word, value):
+        """Return the value, with its case changed to follow the case of
+        the word it replaces: all caps, capitalized, or lowercase."""
+        if word.isupper():
+            return value.upper()
+        if word[:1].isupper():
+            return value[:1].upper() + value[1:]
+        return value.lower()
+
     def _update_regex(self):
         """Build re object based on the keys of the current
         dictionary.
 
         """
-        self._regex = re.compile("|".join(map(self._wordToRegex, self.keys())))
+        self._regex = re.compile("|".join(self._regex_parts), re.IGNORECASE)
         self._regexIsDirty = False
 
+    def _update_automaton(self):
+        """Build an Aho-Corasick automaton that finds the keys of the
+        current dictionary.
+
+        """
+        automaton = ahocorasick.Automaton()
+        # Each word is stored with its position among the keys, since the
+        # first key listed wins when several match at the same place, and
+        # with its replacement, so matches needn't be looked up again.
+        for priority, (key, value) in enumerate(self._map.items()):
+            automaton.add_word(key, (priority, len(key), value))
+        if len(automaton):
+            automaton.make_automaton()
+        self._automaton = automaton
+
     def __init__(self, values=None):
         """Initialize the object, and populate it with the entries in
         the defaults dictionary.
         """
-        super().__init__()
+        self._map = {}  # the replacement for each lowercase key
+        self._cache = {}  # recent translations, keyed by the original text
+        self._regex_parts = []  # the regex for each key, in order
+        self._regex = None
+        self._automaton = None
+        self._regexIsDirty = True
         if values:
-            if isinstance(values, dict):
+            if isinstance(values, (dict, WordSub)):
                 values = values.items()
             for key, value in values:
                 self[key] = value
-        self._regex = None
-        self._regexIsDirty = True
+            # Build the matcher now, while the bot is being set up, rather
+            # than while it's responding for the first time.
+            if ahocorasick is not None:
+                self._update_automaton()
+            else:
+                self._update_regex()
 
     def __call__(self, match):
         """Handler invoked for each regex match."""
-        return self[match.group(0)]
+        word = match.group(0)
+        value = self._map.get(word.lower())
+        if value is None:
+            # A few characters match a key when ignoring case, yet don't
+            # lowercase to it, e.g. the long s.
+            return word
+        return self._match_case(word, value)
 
     def __setitem__(self, i, y):
-        self._regexIsDirty = True
-        # for each entry the user adds, we actually add three entries:
-        super().__setitem__(i.lower(), y.lower())  # key = value
-        super().__setitem__(i[:1].upper() + i[1:], y[:1].upper() + y[1:])  # Key = Value
-        super().__setitem__(i.upper(), y.upper())  # KEY = VALUE
+        # Words are matched regardless of case, so only the lowercase key is
+        # stored. The case of the replacement follows the matched word's.
+        key = sys.intern(i.lower())
+        if key not in self._map:
+            # The regex only depends on the keys, so it only needs to be
+            # rebuilt when one is added, and only the new key needs escaping.
+            self._regex_parts.append(self._wordToRegex(key))
+            self._regexIsDirty = True
+        self._automaton = None
+        self._cache.clear()
+        self._map[key] = sys.intern(y)
+
+    def __getitem__(self, i):
+        return self._map[i.lower()]
+
+    def __contains__(self, i):
+        return i.lower() in self._map
+
+    def __len__(self):
+        return len(self._map)
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def get(self, i, default=None):
+        """Return the replacement for the word, or the default if there
+        isn't one."""
+        return self._map.get(i.lower(), default)
+
+    def keys(self):
+        """Return the words that are replaced, in lowercase."""
+        return self._map.keys()
+
+    def items(self):
+        """Return the (lowercase word, replacement) pairs."""
+        return self._map.items()
 
     def sub(self, text):
         """Translate text, returns the modified text."""
+        # The same text is often translated again and again, e.g. by
+        # <srai> reductions, so recent translations are memoized. The
+        # cache is simply emptied when it fills up.
+        result = self._cache.get(text)
+        if result is None:
+            if len(self._cache) >= self._max_cache_size:
+                self._cache.clear()
+            result = self._cache[text] = self._translate(text)
+        return result
+
+    def sub_many(self, texts):
+        """Translate each of the texts, returns a list of the modified
+        texts."""
+        texts = list(texts)
+        if not texts:
+            return []
+        # The texts are joined and translated in a single pass. The separator
+        # isn't a word character, so words can't run across it, unless one
+        # of the texts contains it.
+        separator = self._separator
+        if any(separator in text for text in texts):
+            return [self.sub(text) for text in texts]
+        return self._translate(separator.join(texts)).split(separator)
+
+    def _translate(self, text):
+        """Translate text without consulting the cache."""
+        # With only a few keys, checking the text for each of them is
+        # quicker than running the matcher, and most text has none of them.
+        if len(self._map) <= self._max_prefiltered_size:
+            lowered = text.lower()
+            if not any(key in lowered for key in self._map):
+                return text
+        if ahocorasick is not None:
+            return self._sub_automaton(text)
         if self._regexIsDirty:
             self._update_regex()
         return self._regex.sub(self, text)
+
+    def _sub_automaton(self, text):
+        """Translate text using the Aho-Corasick automaton. Matches are
+        chosen exactly as the regular expression would choose them: the
+        leftmost complete word wins, and ties go to the first key."""
+        if self._automaton is None:
+            self._update_automaton()
+        if not len(self._automaton):
+            return text
+        # The keys are lowercase, so the automaton scans a lowercase copy of
+        # the text. In the rare case that changes the length of the text,
+        # the positions wouldn't line up, so the regex is used instead.
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            if self._regexIsDirty:
+                self._update_regex()
+            return self._regex.sub(self, text)
+
+        # Find the best whole-word match starting at each position.
+        best = {}
+        for end, (priority, length, value) in self._automaton.iter(lowered):
+            start = end + 1 - length
+            if not (_is_word_boundary(text, start) and _is_word_boundary(text, end + 1)):
+                continue
+            match = best.get(start)
+            if match is None or priority < match[0]:
+                best[start] = (priority, end + 1, value)
+        if not best:
+            return text
+
+        # Splice in the replacements, skipping overlapping matches.
+        parts = []
+        position = 0
+        for start in sorted(best):
+            if start < position:
+                continue
+            priority, end, value = best[start]
+            parts.append(text[position:start])
+            parts.append(self._match_case(text[start:end], value))
+            position = end
+        parts.append(text[position:])
+        return ''.join(parts)